@@ -1,4 +1,6 @@
 import time
+import argparse
+import multiprocessing
 from tkinter import Tk, Toplevel, Label, ttk
 from src.user_interface.ui_utils import get_fintelmann_logo, get_mgh_logo, get_font_size, get_falcon
 VERSION = "v1.0.0"
@@ -36,6 +38,11 @@ def show_loading_popup():
     return loading_window
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() #preprocessing worker processes in the frozen executable
+    parser = argparse.ArgumentParser(description="FALCON")
+    parser.add_argument("--inference-backend", choices=["torch", "onnx"], default=None,
+                        help="Run the models with PyTorch or ONNX Runtime (overrides the setting).")
+    args, _ = parser.parse_known_args()
     root = Tk()
     root.withdraw()  # Hide the main window initially
 
@@ -53,5 +60,5 @@ if __name__ == "__main__":
 
     # Show the main application
     root.deiconify()  # Show the main window
-    app = CTScanSeriesPredictionApp(root, VERSION)
+    app = CTScanSeriesPredictionApp(root, VERSION, inference_backend=args.inference_backend)
     root.mainloop()
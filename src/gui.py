@@ -4,7 +4,7 @@
 import os
 from tkinter import filedialog, END
 import shutil
-from src.processing_logic import process_loop
+from src.processing_logic import process_loop, get_model_registry
 from src.prediction.prediction_utils import get_device
 from src.user_interface.settings_manager import SettingsManager
 from src.user_interface.reset_popup import show_reset_popup
@@ -12,21 +12,25 @@ from src.user_interface.edit_popup import show_edit_popup
 from src.user_interface.provide_popup import show_provide_popup
 from src.user_interface.build_gui import build_gui
 from src.user_interface.ui_utils import update_start_button, update_reset_button, setup_sorting, reset_sorting, sort_df
-from src.preprocessing.series_manager import load_and_display_series
+from src.preprocessing.series_manager import load_and_display_series, cancel_listing
 
 class CTScanSeriesPredictionApp:
-    def __init__(self, root, version="v1.0.0"):
+    def __init__(self, root, version="v1.0.0", inference_backend=None):
         self.root = root
         self.series_data = []
         self.all_series_data = []
         self.predicted_series = []
+        self.rejected_series = []
+        self.listing = None #background series listing, if one is running
         self.is_paused = False
         self.prediction_in_progress = False
+        self.loop_running = False #process_loop is running (possibly paused while it waits for a series or a model)
         self.index_mapping = {}
         self.directory = None
         self.out_dir = None
         self.device = get_device()
         self.reset_allowed = False
+        self.inference_backend = inference_backend #set on the command line, overrides the setting
 
         #For table sorting
         self._series_sort_column = None
@@ -36,11 +40,14 @@ class CTScanSeriesPredictionApp:
 
         self.settings_manager = SettingsManager()
         self.settings = self.settings_manager.load_settings()
+        self.models = None
+        try: get_model_registry(self).preload() #the body-part model loads in the background while the GUI is used, contrast models on first use
+        except Exception as e: print(e) #shown again in the GUI when the prediction is started
         build_gui(self, version=version)
 
     def open_settings(self): #Called by Settings Button
         """Opens the settings window."""
-        if not self.prediction_in_progress:
+        if not self.prediction_in_progress and not self.loop_running:
             prev_txt = self.progress_var.get()
             self.progress_var.set("Please answer the pop-up window.")
             reset_happened = self.settings_manager.open_settings_window(self)
@@ -49,6 +56,9 @@ class CTScanSeriesPredictionApp:
             self.update_tables()
             if not reset_happened: self.progress_var.set(prev_txt)
 
+    def get_inference_backend(self):
+        return self.inference_backend or self.settings.get("inference_backend", "torch")
+
     def start_prediction(self): #Called by Start Prediction Button
         """Starts or resumes the prediction process for each series."""
         if self.prediction_in_progress: #User pressed pause button
@@ -57,9 +67,14 @@ class CTScanSeriesPredictionApp:
             self.prediction_in_progress = False
             self.is_paused = True
             #self.reset_button.config(state="normal", cursor="hand2")
-            update_reset_button(self, "Active")
+            if not self.loop_running: update_reset_button(self, "Active") #else the loop enables it once it has stopped
             prev_txt = self.progress_var.get()
             self.progress_var.set(prev_txt + "   (paused)")
+        elif self.is_paused and self.loop_running: #User pressed play before the loop noticed the pause, it just continues
+            self.is_paused = False
+            self.prediction_in_progress = True
+            update_start_button(self,"Pause")
+            self.progress_var.set(self.progress_var.get().replace("   (paused)", ""))
         elif self.is_paused: #User pressed play during pause
             self.is_paused = False
             self.start_prediction()
@@ -81,6 +96,7 @@ class CTScanSeriesPredictionApp:
 
     def select_directory(self): #Called by Browse button
         """Opens a file dialog to select a directory and brings focus back to the main window."""
+        if self.loop_running: return #a new listing resets the GUI, only once the prediction loop has stopped
         selected_directory = filedialog.askdirectory()
         if selected_directory:
             self.directory_var.set(selected_directory)
@@ -152,12 +168,17 @@ class CTScanSeriesPredictionApp:
 
     def list_series(self): #Called by List Series Button
         """List and display series in the selected directory."""
+        if self.loop_running: return
         self.reset_gui()
         load_and_display_series(self)
 
+    def cancel_listing(self): #Called by Cancel button during the series listing
+        cancel_listing(self)
+
     def reset(self, show_confirm=True): #Called by Reset Button
         """Shows a confirmation popup before resetting progress."""
         if show_confirm and not self.reset_allowed: return
+        if self.loop_running: return #the prediction loop still runs, reset once it has stopped
         if self.directory:
             def reset_prediction(reset=True, prev_txt='', delete_files=True):
                 if reset:
@@ -180,6 +201,7 @@ class CTScanSeriesPredictionApp:
         self.series_data = []
         self.all_series_data = []
         self.predicted_series = []
+        self.rejected_series = []
         reset_sorting(self)
         self.update_tables()
         self.is_paused = False
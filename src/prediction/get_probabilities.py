@@ -1,6 +1,5 @@
 import SimpleITK as sitk
 import numpy as np
-import torch
 
 #Range for the normalization
 HN_SLICE_RANGE = range(35,75)
@@ -15,38 +14,89 @@ CH_SLICE_IDX = 15
 AB_SLICE_IDX = 43
 
 
+#All slabs lie within this range, it is read once per series and shared by the inputs of all models
+INPUT_SLICE_RANGE = range(20,80)
+
+#Number of arrays allocated while building model inputs (one per input, one per stacked batch of several inputs).
+#Tests can compare it before and after building the inputs of a series.
+input_allocations = 0
+
 def get_body_part_probabilities(model, nrrd_file, device='cpu'):
-    img_arr = sitk.GetArrayFromImage(nrrd_file)
-    data = img_arr[BP_SLICE_RANGE, :, :]
-    
-    data = np.clip(data, a_min=-200, a_max=200)
-    MAX, MIN = data.max(), data.min()
-    data = (data - MIN) / (MAX - MIN)
-    data_single_slice = data[BP_SLICE_IDX, :, :]
-    data_3ch = np.broadcast_to(data_single_slice[np.newaxis, ...], (3, data_single_slice.shape[0], data_single_slice.shape[1]))
-    data_3ch = np.copy(data_3ch)
-    img = torch.from_numpy(data_3ch).float().to(device)
-    with torch.no_grad():
-        output = model(img.unsqueeze(0)).cpu() #add batch dimension
-    probabilities = torch.softmax(output, dim=1).squeeze(0) #remove batch dim
-    return probabilities.cpu().numpy() # e.g. [10%, 75%, 15%]
+    return get_body_part_probabilities_batch(model, [get_body_part_input(get_volume_view(nrrd_file))], device=device)[0] # e.g. [10%, 75%, 15%]
 
 def get_contrast_probability(model, img, part, device='cpu'):
+    return get_contrast_probabilities_batch(model, [get_contrast_input(get_volume_view(img), part)], device=device)[0].item()
+
+def get_volume_view(img):
+    """Read-only array of the slices in INPUT_SLICE_RANGE of a preprocessed volume. Volumes already in memory (sitk image,
+    SharedVolume) are not copied, so the view is only valid as long as the volume is."""
+    view = get_slab_array(img, INPUT_SLICE_RANGE).view()
+    view.flags.writeable = False
+    return view
+
+def get_body_part_input(view):
+    return get_model_input(view, BP_SLICE_RANGE, BP_SLICE_IDX)
+
+def get_contrast_input(view, part):
     slice_range, slice_idx = get_slices(part)
-    img_arr = sitk.GetArrayFromImage(img)
-    data = img_arr[slice_range, :, :]
-    
-    data = np.clip(data, a_min=-200, a_max=200)
-    MAX, MIN = data.max(), data.min()
-    data = (data - MIN) / (MAX - MIN)
-    data_single_slice = data[slice_idx, :, :]
-    data_3ch = np.broadcast_to(data_single_slice[np.newaxis, ...], (3, data_single_slice.shape[0], data_single_slice.shape[1]))
-    data_3ch = np.copy(data_3ch)
-    img = torch.from_numpy(data_3ch).float().to(device)
+    return get_model_input(view, slice_range, slice_idx)
+
+def get_model_input(view, slice_range, slice_idx):
+    """3-channel model input (float32, channels x rows x cols) of one series: the slice at slice_idx of the slab in 
+    slice_range, clipped to [-200, 200] and normalized with the min / max of the clipped slab.
+    Clipping is monotonic, so the min / max of the clipped slab are the clipped min / max of the view and only the 
+    output array is allocated."""
+    global input_allocations
+    start = slice_range.start - INPUT_SLICE_RANGE.start
+    slab = view[start:start + len(slice_range)]
+    MIN = np.float32(min(max(slab.min(), -200), 200))
+    MAX = np.float32(min(max(slab.max(), -200), 200))
+    data_3ch = np.empty((3, slab.shape[1], slab.shape[2]), dtype=np.float32)
+    input_allocations += 1
+    np.clip(slab[slice_idx], -200, 200, out=data_3ch[0])
+    data_3ch[0] -= MIN
+    data_3ch[0] /= MAX - MIN
+    data_3ch[1:] = data_3ch[0]
+    return data_3ch
+
+def stack_inputs(inputs):
+    """Batch (N x channels x rows x cols) of model inputs, a single input is used without copying."""
+    global input_allocations
+    if len(inputs) == 1: return inputs[0][np.newaxis]
+    input_allocations += 1
+    return np.stack(inputs)
+
+def get_body_part_probabilities_batch(model, inputs, device='cpu'):
+    """Body-part probabilities (N x 3) for a list of N model inputs, in one forward pass."""
+    from src.prediction.onnx_backend import OnnxModel
+    batch = stack_inputs(inputs)
+    if isinstance(model, OnnxModel):
+        output = model(batch)
+        output = np.exp(output - output.max(axis=1, keepdims=True))
+        return output / output.sum(axis=1, keepdims=True)
+    import torch #only needed for the PyTorch backend
+    img = torch.from_numpy(batch).to(device)
     with torch.no_grad():
-        output = model(img.unsqueeze(0)).cpu() #add batch dimension
-    probability = torch.sigmoid(output).squeeze().cpu().numpy() #remove batch dimension and class dimension
-    return probability.item()
+        output = model(img).cpu()
+    probabilities = torch.softmax(output, dim=1)
+    return probabilities.cpu().numpy()
+
+def get_contrast_probabilities_batch(model, inputs, device='cpu'):
+    """Contrast probabilities (N) for a list of N model inputs, in one forward pass."""
+    from src.prediction.onnx_backend import OnnxModel
+    batch = stack_inputs(inputs)
+    if isinstance(model, OnnxModel): return (1 / (1 + np.exp(-model(batch)))).reshape(-1)
+    import torch #only needed for the PyTorch backend
+    img = torch.from_numpy(batch).to(device)
+    with torch.no_grad():
+        output = model(img).cpu()
+    return torch.sigmoid(output).reshape(-1).cpu().numpy() #remove class dimension
+
+def get_slab_array(img, slice_range):
+    """Return the slices in slice_range of a preprocessed volume, given as sitk image, as StoredVolume from the 
+    preprocessed store (which only decompresses the requested slices) or as SharedVolume from a worker process."""
+    if isinstance(img, sitk.Image): return sitk.GetArrayViewFromImage(img)[slice_range.start:slice_range.stop]
+    return img.read_slices(slice_range)
 
 def get_slices(part):
     if part == 'HeadNeck': return HN_SLICE_RANGE, HN_SLICE_IDX
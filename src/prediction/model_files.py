@@ -0,0 +1,13 @@
+import os
+import tempfile
+
+def get_derived_path(pth_path, suffix, fallback_dir):
+    """File derived from a .pth model (e.g. its ONNX export or a reduced-precision version): next to the .pth file,
+    or in fallback_dir in the temp directory if that is not writable (e.g. a read-only installation)."""
+    derived_path = os.path.splitext(pth_path)[0] + suffix
+    if is_up_to_date(derived_path, pth_path) or os.access(os.path.dirname(pth_path), os.W_OK): return derived_path
+    return os.path.join(tempfile.gettempdir(), fallback_dir, os.path.basename(derived_path))
+
+def is_up_to_date(derived_path, pth_path):
+    """Whether a derived file exists and is not older than the .pth file it was created from."""
+    return os.path.exists(derived_path) and os.path.getmtime(derived_path) >= os.path.getmtime(pth_path)
@@ -0,0 +1,79 @@
+import os
+import time
+import numpy as np
+from src.prediction.model_files import get_derived_path, is_up_to_date
+
+#Opset used for the export, supported by all current ONNX Runtime releases
+ONNX_OPSET = 17
+#Max. absolute difference of the raw model outputs between PyTorch and ONNX Runtime accepted after an export
+PARITY_TOLERANCE = 1e-4
+PARITY_BATCH_SIZE = 4
+
+class OnnxModel:
+    """ResNet9 exported to ONNX, run with ONNX Runtime on the CPU. Called with a float32 batch
+    (N x 3 x rows x cols), returns the raw model output as array (N x classes)."""
+    def __init__(self, path, threads=0):
+        ort = import_onnxruntime()
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads #0: ONNX Runtime default
+        self.path = path
+        self.session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(batch, dtype=np.float32)})[0]
+
+def import_onnxruntime():
+    try: import onnxruntime
+    except ImportError:
+        raise Exception("The ONNX inference backend needs the packages onnxruntime and onnx (see the environment files). "
+                        "Install them or set inference_backend to \"torch\".")
+    return onnxruntime
+
+def get_onnx_path(pth_path):
+    """Cached ONNX graph of a model (see get_derived_path)."""
+    return get_derived_path(pth_path, ".onnx", "falcon_onnx")
+
+def load_onnx_model(name, verbose=False):
+    """Load one of the models in MODEL_PATHS with ONNX Runtime. The graph is exported once and reused until the
+    .pth file changes, only the export needs PyTorch."""
+    from src.prediction.prediction_utils import MODEL_PATHS
+    onnx_path = get_onnx_path(MODEL_PATHS[name])
+    if not is_up_to_date(onnx_path, MODEL_PATHS[name]): export_onnx(name, onnx_path, verbose=verbose)
+    return OnnxModel(onnx_path)
+
+def export_onnx(name, onnx_path, verbose=False):
+    """Export a model to ONNX (with a dynamic batch dimension) and check the exported graph against PyTorch.
+    The graph is written to a temporary file first, so a failed export or parity check leaves no cached graph behind."""
+    import_onnxruntime() #fail before the export if the backend cannot run
+    import torch
+    from src.prediction.prediction_utils import load_model
+    from src.preprocessing.preprocess_series import SCALE_SIZE #imported here, preprocess_series imports the prediction modules
+    start_time = time.time()
+    model = load_model(name, 'cpu')
+    os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+    tmp_path = onnx_path + ".tmp"
+    dummy_input = torch.zeros((1, 3, SCALE_SIZE[0], SCALE_SIZE[1]), dtype=torch.float32)
+    try:
+        torch.onnx.export(model, dummy_input, tmp_path, input_names=["input"], output_names=["output"], opset_version=ONNX_OPSET,
+                          dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}})
+        max_diff = check_parity(model, OnnxModel(tmp_path))
+        if max_diff > PARITY_TOLERANCE:
+            raise Exception(f"ONNX export of the {name} model differs from PyTorch by {max_diff:.2e} (tolerance {PARITY_TOLERANCE:.0e}).")
+        os.replace(tmp_path, onnx_path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    if verbose: print(f"Exported the {name} model to {onnx_path} in {time.time() - start_time:.2f}s (max. difference to PyTorch: {max_diff:.2e}).")
+
+def check_parity(torch_model, onnx_model, inputs=None, seed=0):
+    """Max. absolute difference between the raw outputs of the PyTorch model and its ONNX export.
+    Without inputs, a batch of random inputs in the value range of the model inputs ([0, 1]) is used."""
+    import torch
+    from src.preprocessing.preprocess_series import SCALE_SIZE
+    if inputs is None:
+        rng = np.random.default_rng(seed)
+        inputs = rng.random((PARITY_BATCH_SIZE, 3, SCALE_SIZE[0], SCALE_SIZE[1]), dtype=np.float32)
+    with torch.no_grad():
+        torch_output = torch_model(torch.from_numpy(inputs)).numpy()
+    return float(np.abs(torch_output - onnx_model(inputs)).max())
@@ -1,8 +1,10 @@
-from PrivateModelArchitectures.classification import ResNet9
-import torch
 import os
 import csv
-from src.user_interface.ui_utils import resource_path
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.user_interface.ui_utils import resource_path, wait_for_future
+from src.prediction.onnx_backend import load_onnx_model, import_onnxruntime
+from src.prediction.quantization import load_reduced_model
 
 # Define relative model paths
 BODY_PART_MODEL_PATH = resource_path("models/body_part_model.pth")
@@ -11,38 +13,60 @@ CHEST_MODEL_PATH = resource_path("models/chest_model.pth")
 HN_MODEL_PATH = resource_path("models/headneck_model.pth")
 
 
+MODEL_PATHS = {"part": BODY_PART_MODEL_PATH, "HeadNeck": HN_MODEL_PATH, "Chest": CHEST_MODEL_PATH, "Abdomen": ABDOMEN_MODEL_PATH}
+
 def load_models(device='cpu'):
-    part_model = ResNet9(in_channels=3, num_classes=3, act_func=torch.nn.Sigmoid, scale_norm=True, norm_layer='group')
-    hn_model = ResNet9(in_channels=3, num_classes=1, act_func=torch.nn.Sigmoid, scale_norm=True, norm_layer='group')
-    ch_model = ResNet9(in_channels=3, num_classes=1, act_func=torch.nn.Sigmoid, scale_norm=True, norm_layer='group')
-    ab_model = ResNet9(in_channels=3, num_classes=1, act_func=torch.nn.Sigmoid, scale_norm=True, norm_layer='group')
-    
-    part_original_state_dict = torch.load(BODY_PART_MODEL_PATH, map_location=device, weights_only=True)
-    part_adjusted_state_dict = remove_module_prefix(part_original_state_dict)
-    part_model.load_state_dict(part_adjusted_state_dict)
-    part_model.to(device)
-    part_model.eval()
-
-    hn_original_state_dict = torch.load(HN_MODEL_PATH, map_location=device, weights_only=True)
-    hn_adjusted_state_dict = remove_module_prefix(hn_original_state_dict)
-    hn_model.load_state_dict(hn_adjusted_state_dict)
-    hn_model.to(device)
-    hn_model.eval()
-
-    ch_original_state_dict = torch.load(CHEST_MODEL_PATH, map_location=device, weights_only=True)
-    ch_adjusted_state_dict = remove_module_prefix(ch_original_state_dict)
-    ch_model.load_state_dict(ch_adjusted_state_dict)
-    ch_model.to(device)
-    ch_model.eval()
-
-    ab_original_state_dict = torch.load(ABDOMEN_MODEL_PATH, map_location=device, weights_only=True)
-    ab_adjusted_state_dict = remove_module_prefix(ab_original_state_dict)
-    ab_model.load_state_dict(ab_adjusted_state_dict)
-    ab_model.to(device)
-    ab_model.eval()
-
-
-    return part_model, hn_model, ch_model, ab_model
+    return tuple(load_model(name, device) for name in MODEL_PATHS) #part_model, hn_model, ch_model, ab_model
+
+def load_model(name, device='cpu'):
+    """Load one of the models in MODEL_PATHS: the body-part model ("part") or the contrast model of a body-part."""
+    import torch #imported here, so the ONNX backend runs without PyTorch once the models are exported
+    from PrivateModelArchitectures.classification import ResNet9
+    model = ResNet9(in_channels=3, num_classes=3 if name == "part" else 1, act_func=torch.nn.Sigmoid, scale_norm=True, norm_layer='group')
+    original_state_dict = torch.load(MODEL_PATHS[name], map_location=device, weights_only=True)
+    adjusted_state_dict = remove_module_prefix(original_state_dict)
+    model.load_state_dict(adjusted_state_dict)
+    model.to(device)
+    model.eval()
+    return model
+
+class ModelRegistry:
+    """Keeps the models loaded for the lifetime of the application, so pausing and resuming does not load them again.
+    Models are loaded one at a time in a background thread: preload() at application start, the remaining ones when
+    they are first requested, so a contrast model is only loaded once a series of its body-part needs it.
+    The load time of every model is kept in load_times (seconds).
+    backend is "torch" (eager PyTorch) or "onnx" (ONNX Runtime, see onnx_backend). With the PyTorch backend, precision
+    "int8" or "bfloat16" uses the versions of the models accepted by the validation harness (see quantization)."""
+    def __init__(self, device='cpu', verbose=False, backend="torch", precision="float32"):
+        self.device = device
+        self.verbose = verbose
+        self.backend = backend
+        self.precision = precision
+        if backend == "onnx": import_onnxruntime() #a clear error now instead of a failed model load later
+        if backend == "onnx" and precision != "float32": print(f"{precision} inference is only available with the PyTorch backend, using float32.")
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = {}
+        self.load_times = {}
+
+    def preload(self, names=("part",)):
+        for name in names: self.start_loading(name)
+
+    def start_loading(self, name):
+        if name not in self.futures: self.futures[name] = self.executor.submit(self.timed_load, name)
+        return self.futures[name]
+
+    def timed_load(self, name):
+        start_time = time.time()
+        if self.backend == "onnx": model = load_onnx_model(name, verbose=self.verbose)
+        elif self.precision != "float32": model = load_reduced_model(name, self.precision, verbose=self.verbose) or load_model(name, self.device)
+        else: model = load_model(name, self.device)
+        self.load_times[name] = time.time() - start_time
+        if self.verbose: print(f"Loaded the {name} model ({self.backend}, {self.precision}) in {self.load_times[name]:.2f}s.")
+        return model
+
+    def get(self, name, wait_callback=None):
+        """Return the model, waiting for it to be loaded if necessary."""
+        return wait_for_future(self.start_loading(name), wait_callback)
 
 def remove_module_prefix(state_dict):
     """Remove the '_module.' prefix from each key in the state dictionary."""
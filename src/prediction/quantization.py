@@ -0,0 +1,196 @@
+import io
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import numpy as np
+from src.prediction.model_files import get_derived_path, is_up_to_date
+
+PRECISIONS = ["int8", "bfloat16"]
+#Min. fraction of the reference inputs for which the reduced model has to predict the same label as float32
+AGREEMENT_THRESHOLD = 0.99
+CALIBRATION_FRACTION = 0.5 #of the reference inputs used to calibrate the int8 models, the rest validates
+BENCHMARK_BATCH_SIZE = 8
+BENCHMARK_REPEATS = 3
+REPORT_FILE = "quantization_report.json"
+#Min. number of validation volumes: with fewer, a single disagreeing label already drops the agreement below the
+#threshold, and full agreement on a handful of volumes says little about the accuracy of the reduced model
+MIN_VALIDATION_SIZE = 100
+
+def get_reduced_path(pth_path, precision):
+    """Validated reduced-precision model (TorchScript) of a model (see get_derived_path)."""
+    return get_derived_path(pth_path, f".{precision}.pt", "falcon_reduced")
+
+def load_reduced_model(name, precision, verbose=False):
+    """Load the reduced-precision version of a model, if the validation harness has accepted it for the current .pth
+    file. Returns None otherwise, the caller then keeps using float32."""
+    import torch
+    from src.prediction.prediction_utils import MODEL_PATHS
+    reduced_path = get_reduced_path(MODEL_PATHS[name], precision)
+    if not is_up_to_date(reduced_path, MODEL_PATHS[name]):
+        print(f"No validated {precision} version of the {name} model, using float32. "
+              f"Run 'python -m src.prediction.quantization <reference dir> --precision {precision}' to create one.")
+        return None
+    if verbose: print(f"Using the validated {precision} version of the {name} model ({reduced_path}).")
+    return torch.jit.load(reduced_path, map_location='cpu').eval()
+
+def cpu_supports_bfloat16():
+    """Whether the CPU computes bfloat16 natively. Without native support bfloat16 is emulated and slower than
+    float32. If the CPU flags cannot be read (other than Linux), the benchmark of the harness decides."""
+    try:
+        with open("/proc/cpuinfo") as f: flags = f.read()
+    except OSError: return True
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+def to_int8(model, calibration_inputs):
+    """Static int8 quantization (FX graph mode), calibrated on calibration_inputs. Falls back to dynamic quantization
+    of the linear layers if the model cannot be traced. Returns (quantized model, method).
+    The fallback leaves all convolutions in float32; for ResNet9 only the final classifier layer is quantized, so it
+    saves almost no latency or memory (method "dynamic" in the report)."""
+    import torch
+    from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    model = copy.deepcopy(model).eval()
+    try:
+        example = torch.from_numpy(calibration_inputs[:1])
+        prepared = prepare_fx(model, get_default_qconfig_mapping(torch.backends.quantized.engine), example_inputs=(example,))
+        with torch.no_grad():
+            for start in range(0, len(calibration_inputs), BENCHMARK_BATCH_SIZE):
+                prepared(torch.from_numpy(calibration_inputs[start:start + BENCHMARK_BATCH_SIZE]))
+        return convert_fx(prepared).eval(), "static"
+    except Exception as e:
+        print(f"Static quantization failed ({e}), using dynamic quantization of the linear layers. "
+              "The convolutions stay float32, expect almost no savings.")
+        return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8).eval(), "dynamic"
+
+def to_bfloat16(model):
+    """Copy of the model with bfloat16 weights, taking and returning float32 like the original."""
+    import torch
+    class BFloat16Model(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model.to(torch.bfloat16)
+        def forward(self, x):
+            return self.model(x.to(torch.bfloat16)).float()
+    return BFloat16Model(copy.deepcopy(model)).eval()
+
+def to_torchscript(model, example):
+    """Traced TorchScript version of the model and its serialized size in bytes (the model memory)."""
+    import torch
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.from_numpy(example))
+    buffer = io.BytesIO()
+    torch.jit.save(traced, buffer)
+    return traced, buffer.tell()
+
+def get_predictions(name, model, inputs):
+    """Labels and confidences as reported by predict_batch for a model and a stack of inputs."""
+    from src.prediction.get_probabilities import get_body_part_probabilities_batch, get_contrast_probabilities_batch
+    if name == "part":
+        probabilities = get_body_part_probabilities_batch(model, list(inputs))
+        labels = probabilities.argmax(axis=1)
+        return labels, probabilities[np.arange(len(labels)), labels]
+    probabilities = get_contrast_probabilities_batch(model, list(inputs))
+    labels = (probabilities >= 0.5).astype(int)
+    return labels, np.where(labels == 1, probabilities, 1 - probabilities)
+
+def get_latency(name, model, inputs):
+    """Best time per input (ms) of BENCHMARK_REPEATS runs over the inputs in batches of BENCHMARK_BATCH_SIZE."""
+    times = []
+    for _ in range(BENCHMARK_REPEATS):
+        start_time = time.perf_counter()
+        for start in range(0, len(inputs), BENCHMARK_BATCH_SIZE): get_predictions(name, model, inputs[start:start + BENCHMARK_BATCH_SIZE])
+        times.append((time.perf_counter() - start_time) / len(inputs) * 1000)
+    return min(times)
+
+def load_reference_inputs(reference_dir):
+    """Model inputs of all preprocessed volumes in reference_dir (.nrrd files and/or a preprocessed store), as
+    {model name: stacked inputs}. Every contrast model is validated on all volumes, not only those of its body-part."""
+    import SimpleITK as sitk
+    from src.prediction.get_probabilities import get_volume_view, get_body_part_input, get_contrast_input
+    from src.preprocessing.volume_store import STORE_FILE, StoredVolume, open_volume_store
+    volumes = [sitk.ReadImage(os.path.join(reference_dir, f)) for f in sorted(os.listdir(reference_dir)) if f.endswith(".nrrd")]
+    if os.path.exists(os.path.join(reference_dir, STORE_FILE)):
+        conn = open_volume_store(reference_dir)
+        try: keys = [row[0] for row in conn.execute("SELECT key FROM volumes ORDER BY key")]
+        finally: conn.close()
+        volumes += [StoredVolume(reference_dir, key) for key in keys]
+    inputs = {"part": [], "HeadNeck": [], "Chest": [], "Abdomen": []}
+    for volume in volumes:
+        view = get_volume_view(volume)
+        inputs["part"].append(get_body_part_input(view))
+        for part in ["HeadNeck", "Chest", "Abdomen"]: inputs[part].append(get_contrast_input(view, part))
+    return {name: np.stack(model_inputs) for name, model_inputs in inputs.items() if model_inputs}
+
+def validate(reference_dir, precision, threshold=AGREEMENT_THRESHOLD, calibration_fraction=CALIBRATION_FRACTION,
+             min_validation_size=MIN_VALIDATION_SIZE, verbose=False):
+    """Create the reduced-precision version of each model, compare its labels and confidences against float32 on the
+    validation part of the reference set and save it only if the label agreement reaches the threshold and it saves
+    latency or model memory.
+    Returns the report (per model: agreement, confidence differences, latency and model memory of both versions)."""
+    import torch
+    from src.prediction.prediction_utils import MODEL_PATHS, load_model
+    if precision == "bfloat16" and not cpu_supports_bfloat16():
+        raise Exception("This CPU has no native bfloat16 support, bfloat16 inference would be slower than float32.")
+    reference_inputs = load_reference_inputs(reference_dir)
+    num_volumes = len(reference_inputs["part"]) if reference_inputs else 0
+    num_calibration = max(1, min(num_volumes - 1, int(num_volumes * calibration_fraction)))
+    if num_volumes - num_calibration < max(1, min_validation_size):
+        raise Exception(f"{reference_dir} holds {num_volumes} preprocessed volumes, {max(0, num_volumes - num_calibration)} of them for validation. "
+                        f"At least {min_validation_size} validation volumes are needed (calibration fraction {calibration_fraction}).")
+    report = {"precision": precision, "threshold": threshold, "reference_dir": os.path.abspath(reference_dir),
+              "num_calibration": num_calibration, "num_validation": num_volumes - num_calibration, "models": {}}
+    for name, inputs in reference_inputs.items():
+        calibration_inputs, validation_inputs = inputs[:num_calibration], inputs[num_calibration:]
+        model = load_model(name, 'cpu')
+        if precision == "int8": reduced_model, method = to_int8(model, calibration_inputs)
+        else: reduced_model, method = to_bfloat16(model), "bfloat16"
+        float_model, float_bytes = to_torchscript(model, inputs[:1])
+        reduced_model, reduced_bytes = to_torchscript(reduced_model, inputs[:1])
+
+        float_labels, float_confs = get_predictions(name, float_model, validation_inputs)
+        reduced_labels, reduced_confs = get_predictions(name, reduced_model, validation_inputs)
+        agreement = float((float_labels == reduced_labels).mean())
+        conf_diffs = np.abs(float_confs - reduced_confs)
+        result = {"method": method, "agreement": agreement, "max_confidence_diff": float(conf_diffs.max()),
+                  "mean_confidence_diff": float(conf_diffs.mean()),
+                  "float32_ms": get_latency(name, float_model, validation_inputs), "reduced_ms": get_latency(name, reduced_model, validation_inputs),
+                  "float32_bytes": float_bytes, "reduced_bytes": reduced_bytes}
+        #a version that is neither faster nor smaller (e.g. the dynamic fallback) only costs accuracy
+        result["enabled"] = agreement >= threshold and (result["reduced_ms"] < result["float32_ms"] or reduced_bytes < float_bytes)
+        reduced_path = get_reduced_path(MODEL_PATHS[name], precision)
+        if result["enabled"]:
+            os.makedirs(os.path.dirname(reduced_path), exist_ok=True)
+            torch.jit.save(reduced_model, reduced_path + ".tmp")
+            os.replace(reduced_path + ".tmp", reduced_path)
+        elif os.path.exists(reduced_path): os.remove(reduced_path) #an earlier accepted version is no longer valid
+        report["models"][name] = result
+        print_result(name, result, threshold)
+    report_path = os.path.join(os.path.dirname(get_reduced_path(MODEL_PATHS["part"], precision)), REPORT_FILE)
+    with open(report_path, "w") as f: json.dump(report, f, indent=4)
+    if verbose: print(f"Saved the report to {report_path}")
+    return report
+
+def print_result(name, result, threshold):
+    print(f"{name} ({result['method']}): label agreement {result['agreement']*100:.1f}% (threshold {threshold*100:.1f}%), "
+          f"confidence difference max. {result['max_confidence_diff']:.4f} / mean {result['mean_confidence_diff']:.4f}, "
+          f"latency {result['float32_ms']:.1f} -> {result['reduced_ms']:.1f} ms per series "
+          f"({(1 - result['reduced_ms'] / result['float32_ms'])*100:.0f}% saved), "
+          f"model memory {result['float32_bytes']/2**20:.1f} -> {result['reduced_bytes']/2**20:.1f} MB "
+          f"({(1 - result['reduced_bytes'] / result['float32_bytes'])*100:.0f}% saved) - {'enabled' if result['enabled'] else 'REFUSED'}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create and validate reduced-precision versions of the FALCON models.")
+    parser.add_argument("reference_dir", help="Directory with preprocessed volumes (.nrrd files or a preprocessed store), "
+                                              "e.g. the preprocessed folder of a run with stored NRRD files.")
+    parser.add_argument("--precision", choices=PRECISIONS, default="int8")
+    parser.add_argument("--threshold", type=float, default=AGREEMENT_THRESHOLD, help="Min. label agreement with float32.")
+    parser.add_argument("--calibration-fraction", type=float, default=CALIBRATION_FRACTION)
+    parser.add_argument("--min-validation-size", type=int, default=MIN_VALIDATION_SIZE, help="Min. number of validation volumes.")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    report = validate(args.reference_dir, args.precision, threshold=args.threshold, calibration_fraction=args.calibration_fraction,
+                      min_validation_size=args.min_validation_size, verbose=args.verbose)
+    sys.exit(0 if all(result["enabled"] for result in report["models"].values()) else 1)
@@ -1,28 +1,97 @@
-import pydicom
+import io
 import numpy as np
 import glob
 import os
+from pydicom.tag import Tag
+from pydicom.filereader import read_partial
 import SimpleITK as sitk
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from src.preprocessing.volume_cache import get_volume_key, load_cached_volume, store_cached_volume
 
-def get_sitk_from_dicom(dicom_dir, verbose=False, by_ending=True):
-    #dicomFiles = sorted(glob.glob(dicom_dir + '/*.dcm'))
-    all_files = sorted(glob.glob(os.path.join(dicom_dir, "*")))
-    dicomFiles = [file for file in all_files if is_dicom_file(file, by_ending=by_ending)]
-    if verbose: print(f"Gathered all DICOM slices with by_ending = {by_ending}")
-    slices, img_spacing, img_direction, img_origin = load_dicom(dicomFiles)
+#Elements larger than this (i.e. the pixel data) are only read from disk once they are accessed
+DEFERRED_READ_SIZE = "16 KB"
+PIXEL_DATA_TAG = 0x7FE00010
+
+#Tags needed to build the slice table and to decode the pixel data, the values of all other elements are skipped
+LOADING_TAGS = ["ImagePositionPatient", "ImageOrientationPatient", "SliceThickness", "PixelSpacing", "RescaleSlope", "RescaleIntercept",
+                "Rows", "Columns", "SamplesPerPixel", "PhotometricInterpretation", "PlanarConfiguration", "NumberOfFrames",
+                "BitsAllocated", "BitsStored", "HighBit", "PixelRepresentation", "PixelData"]
+
+#Separator of the file names in the "Series Files" column of directories that hold several series
+SERIES_FILES_SEPARATOR = "|"
+
+def get_series_files(dicom_dir, series_files=None):
+    """Sorted paths of the files of a series: the file names listed for it (see SERIES_FILES_SEPARATOR), 
+    or all files in its directory if there is no such list."""
+    if isinstance(series_files, str) and series_files:
+        return sorted(os.path.join(dicom_dir, name) for name in series_files.split(SERIES_FILES_SEPARATOR))
+    return sorted(glob.glob(os.path.join(dicom_dir, "*")))
+
+def get_sitk_from_dicom(dicom_dir, verbose=False, by_ending=True, num_workers=1, cache_dir=None, series_uid=None, files=None, memory=None):
+    if cache_dir:
+        imgCube, img_spacing, img_direction, img_origin = get_hu_volume(dicom_dir, series_uid, cache_dir, verbose=verbose, 
+                                                                        by_ending=by_ending, num_workers=num_workers, files=files, memory=memory)
+        return volume_to_sitk(imgCube, img_spacing, img_direction, img_origin, memory=memory)
+    slices, img_spacing, img_direction, img_origin = get_dicom_slices(dicom_dir, verbose=verbose, by_ending=by_ending, files=files)
+    return slices_to_sitk(slices, img_spacing, img_direction, img_origin, verbose=verbose, num_workers=num_workers, memory=memory)
+
+def get_hu_volume(dicom_dir, series_uid, cache_dir, verbose=False, by_ending=True, num_workers=1, files=None, memory=None):
+    """Return (volume, spacing, direction, origin) of a series, served from the decoded-volume cache if possible.
+    On a hit the volume is a read-only memmap of the cached file, on a miss the series is decoded and stored.
+    A decoded volume is counted in memory (see new_memory), a memmap is not."""
+    key = get_volume_key(series_uid, files if files is not None else get_series_files(dicom_dir), by_ending=by_ending)
+    cached = load_cached_volume(cache_dir, key)
+    if cached is not None:
+        if verbose: print(f"Loaded decoded volume from cache ({key})")
+        return cached
+    slices, img_spacing, img_direction, img_origin = get_dicom_slices(dicom_dir, verbose=verbose, by_ending=by_ending, files=files)
+    imgCube = getPixelArray(slices, num_workers=num_workers, memory=memory)
+    del slices
+    store_cached_volume(cache_dir, key, imgCube, img_spacing, img_direction, img_origin)
+    if verbose: print(f"Stored decoded volume in cache ({key})")
+    return imgCube, img_spacing, img_direction, img_origin
+
+def get_dicom_slices(dicom_dir, verbose=False, by_ending=True, defer_pixels=False, files=None):
+    """Read the slice table and geometry of a series without decoding any pixel data.
+    files is the exact file list of the series from the listing, if None all DICOM files in dicom_dir are used."""
+    if files is not None:
+        dicomFiles = sorted(files) #only files of this series, already checked during the listing
+        if verbose: print(f"Using the {len(dicomFiles)} files listed for this series")
+    else:
+        #dicomFiles = sorted(glob.glob(dicom_dir + '/*.dcm'))
+        all_files = get_series_files(dicom_dir)
+        dicomFiles = [file for file in all_files if is_dicom_file(file, by_ending=by_ending)]
+        if verbose: print(f"Gathered all DICOM slices with by_ending = {by_ending}")
+    slices, img_spacing, img_direction, img_origin = load_dicom(dicomFiles, verbose=verbose, defer_pixels=defer_pixels)
     if verbose: print("Loaded dicom")
     if 0.0 in img_spacing:
         if verbose: print ('ERROR - Zero spacing found for patient,', img_spacing)
         raise Exception("Zero spacing found for patient.")
-    imgCube = getPixelArray(slices)
+    return slices, img_spacing, img_direction, img_origin
+
+def slices_to_sitk(slices, img_spacing, img_direction, img_origin, verbose=False, num_workers=1, memory=None):
+    """Decode the given slices (all or a contiguous part of a series) into a sitk image."""
+    stats = {}
+    imgCube = getPixelArray(slices, num_workers=num_workers, stats=stats, memory=memory)
+    if verbose: print(f"Decoded {len(slices)} slices with {max(1, num_workers)} worker(s), peak memory {stats['peak_bytes']/2**20:.1f} MB for a {stats['volume_bytes']/2**20:.1f} MB volume")
+    return volume_to_sitk(imgCube, img_spacing, img_direction, img_origin, memory=memory)
+
+def volume_to_sitk(imgCube, img_spacing, img_direction, img_origin, memory=None):
+    """sitk copy of a volume. With memory, the copy is counted and the volume is no longer (the caller drops it)."""
     imgSitk = sitk.GetImageFromArray(imgCube)
     imgSitk.SetSpacing(img_spacing)
     imgSitk.SetDirection(img_direction)
     imgSitk.SetOrigin(img_origin)
+    track_bytes(memory, imgCube.nbytes) #the sitk copy, next to the volume
+    if not isinstance(imgCube, np.memmap): track_bytes(memory, -imgCube.nbytes)
     
     return imgSitk
 
-def load_dicom(slice_list):
+SAGITTAL_ORIENTATION = [0, 1, 0, 0, 0, -1]
+AXIAL_ORIENTATION = [1, 0, 0, 0, 1, 0]
+
+def load_dicom(slice_list, verbose=False, defer_pixels=False):
     if len(slice_list)<11:
         raise Exception("Not enough DICOM slices in directory.")
     img_dirs = []
@@ -30,52 +99,161 @@ def load_dicom(slice_list):
         img_type = img_dir.split('/')[-1].split('.')[0]
         if img_type not in ['RTDOSE', 'RTSTRUCT']:
             img_dirs.append(img_dir)
+    table = read_slice_table(img_dirs, defer_pixels=defer_pixels)
+    if verbose: print(f"Read {len(table)} files once each for {len(slice_list)} DICOM files in directory " 
+                      f"({np.mean([row['header_bytes'] for row in table]):.0f} bytes read per file)")
     slices = []
-    for s, t in zip(img_dirs, img_dirs[1:]):
-        slice1 = pydicom.read_file(s)
-        slice2 = pydicom.read_file(t)
-        if slice1.SliceThickness == None:
-            slice1.SliceThickness = float(np.abs(slice1.ImagePositionPatient[2] - slice2.ImagePositionPatient[2]))
-        if slice1.ImageOrientationPatient==[0, 1, 0, 0, 0, -1]:
-            slice1.ImageOrientationPatient=[1, 0, 0, 0, 1, 0]
-            slice2.ImageOrientationPatient=[1, 0, 0, 0, 1, 0]
-        if float(slice1.SliceThickness) == np.abs(slice1.ImagePositionPatient[2] - slice2.ImagePositionPatient[2]):
-            slices.append(slice1)
-        elif slice1.ImageOrientationPatient==[1, 0, 0, 0, 1, 0]:    
-            slices.append(slice1)
-        if t == slice_list[-1]:
-            slices.append(slice2)
-    slices.sort(key=lambda x: float(x.ImagePositionPatient[2]))
-    slice_thickness = np.abs(slices[0].ImagePositionPatient[2] - slices[1].ImagePositionPatient[2])
+    for row, next_row in zip(table, table[1:]):
+        distance = float(np.abs(row["z"] - next_row["z"]))
+        if row["thickness"] is None:
+            row["thickness"] = distance
+        if row["orientation"] == SAGITTAL_ORIENTATION:
+            row["orientation"] = list(AXIAL_ORIENTATION)
+            if next_row["path"] == slice_list[-1]: next_row["orientation"] = list(AXIAL_ORIENTATION)
+        if float(row["thickness"]) == distance:
+            slices.append(row)
+        elif row["orientation"] == AXIAL_ORIENTATION:
+            slices.append(row)
+        if next_row["path"] == slice_list[-1]:
+            slices.append(next_row)
+    slices.sort(key=lambda x: x["z"])
+    slice_thickness = np.abs(slices[0]["z"] - slices[1]["z"])
     if slice_thickness > 3 or slice_thickness == 0:
-        slice_thickness = np.abs(slices[9].ImagePositionPatient[2] - slices[10].ImagePositionPatient[2])
+        slice_thickness = np.abs(slices[9]["z"] - slices[10]["z"])
     for s in slices:
-        s.SliceThickness = slice_thickness
-    img_spacing = [float(slices[0].PixelSpacing[0]), float(slices[0].PixelSpacing[1]), slice_thickness]
-    img_direction = [float(i) for i in slices[0].ImageOrientationPatient] + [0, 0, 1]
-    img_origin = slices[0].ImagePositionPatient
+        s["thickness"] = slice_thickness
+    img_spacing = [slices[0]["pixel_spacing"][0], slices[0]["pixel_spacing"][1], slice_thickness]
+    img_direction = slices[0]["orientation"] + [0, 0, 1]
+    img_origin = slices[0]["position"]
     
     return slices, img_spacing, img_direction, img_origin
 
-def getPixelArray(slices):
+def read_slice_table(img_dirs, defer_pixels=False):
+    """Read every DICOM file exactly once into a slice table (one dict per file, in file order).
+    With defer_pixels, the pixel data is left on disk until a slice is actually decoded.
+    Only LOADING_TAGS are read, header_bytes is the number of bytes fetched from disk for a file."""
+    table = []
+    for img_dir in img_dirs:
+        ds, header_bytes = read_tags(img_dir, LOADING_TAGS, defer_size=DEFERRED_READ_SIZE if defer_pixels else None)
+        thickness = getattr(ds, "SliceThickness", None)
+        table.append({
+            "path": img_dir,
+            "position": [float(p) for p in ds.ImagePositionPatient],
+            "z": float(ds.ImagePositionPatient[2]),
+            "thickness": float(thickness) if thickness not in (None, "") else None,
+            "orientation": [float(o) for o in ds.ImageOrientationPatient],
+            "pixel_spacing": [float(p) for p in ds.PixelSpacing],
+            "slope": float(getattr(ds, "RescaleSlope", 1)),
+            "intercept": float(getattr(ds, "RescaleIntercept", 0)),
+            "dataset": ds, #reference to the parsed file, pixel data is only decoded on access
+            "header_bytes": header_bytes,
+        })
+    return table
 
-    image = np.stack([s.pixel_array for s in slices])
-    image = image.astype(np.int16) #Possible, as values should be <32k
+def getPixelArray(slices, num_workers=1, stats=None, memory=None):
+    """Decode all slices into one int16 buffer and convert it to HU in place.
+    If a dict is passed as stats, it receives the volume size and the peak number of bytes held by this function.
+    memory (see new_memory) receives the decoding peak on top of what it already holds, the volume stays counted."""
+    decoding = new_memory()
+    image = decode_slices(slices, num_workers=num_workers, memory=decoding)
+    track_bytes(memory, decoding["peak"])
+    track_bytes(memory, image.nbytes - decoding["peak"])
 
-    # Convert to Hounsfield units (HU)
-    for slice_number in range(len(slices)):
-        intercept = slices[slice_number].RescaleIntercept
-        slope = slices[slice_number].RescaleSlope
+    # Convert to Hounsfield units (HU), vectorized over runs of slices with equal rescale parameters
+    for first, last, slope, intercept in get_rescale_runs(slices):
+        run = image[first:last] #view, all operations below write into the buffer
         if slope != 1:
-            image[slice_number] = slope * image[slice_number].astype(np.float64)
-            image[slice_number] = image[slice_number].astype(np.int16)
-        image[slice_number] += np.int16(intercept)
-    image[image < -1000] = -1000 #Clip at HU value for air
-    return np.array(image, dtype=np.int16)
+            np.multiply(run, slope, out=run, casting="unsafe") #truncates towards zero like astype(np.int16)
+        run += np.int16(intercept)
+    np.maximum(image, -1000, out=image) #Clip at HU value for air
+
+    if stats is not None:
+        stats["volume_bytes"] = image.nbytes
+        stats["peak_bytes"] = decoding["peak"]
+    return image
+
+def get_rescale_runs(slices):
+    """Split the slices into contiguous runs (first, last, slope, intercept) sharing the same rescale parameters."""
+    runs = []
+    for slice_number, s in enumerate(slices):
+        if runs and runs[-1][2] == s["slope"] and runs[-1][3] == s["intercept"]:
+            runs[-1][1] = slice_number + 1
+        else:
+            runs.append([slice_number, slice_number + 1, s["slope"], s["intercept"]])
+    return runs
+
+def decode_slices(slices, num_workers=1, memory=None):
+    """Decode the pixel data of all slices into one preallocated int16 volume, using a pool of worker threads."""
+    first = slices[0]["dataset"]
+    image = np.empty((len(slices), int(first.Rows), int(first.Columns)), dtype=np.int16) #Possible, as values should be <32k
+    if memory is None: memory = new_memory()
+    track_bytes(memory, image.nbytes + sum(get_pixel_data_bytes(s["dataset"]) for s in slices)) #plus the raw PixelData still held
+
+    def decode(slice_number):
+        ds = slices[slice_number]["dataset"]
+        held_bytes = get_pixel_data_bytes(ds)
+        #pixel_array picks the matching handler (pylibjpeg / gdcm) for compressed transfer syntaxes
+        decoded = ds.pixel_array
+        raw_bytes = get_pixel_data_bytes(ds) #deferred PixelData is only read by pixel_array
+        track_bytes(memory, raw_bytes - held_bytes + decoded.nbytes)
+        image[slice_number] = decoded
+        release_pixel_data(ds)
+        track_bytes(memory, -raw_bytes - decoded.nbytes)
+
+    if num_workers > 1 and len(slices) > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            list(pool.map(decode, range(len(slices)))) #list() re-raises errors from the workers
+    else:
+        for slice_number in range(len(slices)): decode(slice_number)
+    return image
+
+def release_pixel_data(ds):
+    """Drop the raw PixelData and pydicom's cached decoded array of a dataset once its values have been copied into 
+    the volume. The dataset cannot be decoded again afterwards."""
+    ds._pixel_array = None
+    ds._pixel_id = {}
+    if "PixelData" in ds: del ds.PixelData
+
+def get_pixel_data_bytes(ds):
+    """Size of the raw PixelData a dataset holds in memory (0 if it is deferred or already released)."""
+    elem = ds._dict.get(PIXEL_DATA_TAG) #not get_item, which would read deferred PixelData
+    return len(elem.value) if elem is not None and elem.value is not None else 0
+
+def new_memory():
+    """Counter of the bytes held by the arrays of a preprocessing run ("current") and their maximum ("peak").
+    Functions that take it as memory add their buffers while they exist, the caller removes what it drops."""
+    return {"current": 0, "peak": 0, "lock": Lock()}
+
+def track_bytes(memory, nbytes):
+    if memory is None: return
+    with memory["lock"]:
+        memory["current"] += nbytes
+        memory["peak"] = max(memory["peak"], memory["current"])
 
 def is_dicom_file(filepath, by_ending=True):
     """Check if a file is a DICOM file by reading basic metadata."""
     if by_ending: return filepath.endswith(".dcm")
-    try: pydicom.dcmread(filepath, stop_before_pixels=True)
+    try: read_tags(filepath, ["SOPClassUID"], stop_after="SOPClassUID")
     except: return False
-    return True
\ No newline at end of file
+    return True
+
+class CountingFile(io.FileIO):
+    """Binary file opened for reading that counts the bytes actually fetched from disk."""
+    def __init__(self, path):
+        super().__init__(path, "rb")
+        self.bytes_read = 0
+
+    def readinto(self, buffer):
+        n = super().readinto(buffer)
+        self.bytes_read += n or 0
+        return n
+
+def read_tags(filepath, tags, stop_after=None, defer_size=None):
+    """Read only the given tags of a DICOM file, the values of all other elements are skipped instead of read.
+    With stop_after (a tag), parsing ends at the first element behind it. Returns (dataset, bytes read from disk)."""
+    stop_tag = Tag(stop_after) if stop_after is not None else None
+    stop_when = (lambda tag, vr, length: tag > stop_tag) if stop_tag is not None else None
+    raw = CountingFile(filepath)
+    with io.BufferedReader(raw) as f: #the dataset keeps the path, deferred elements are re-read from it
+        ds = read_partial(f, stop_when, defer_size=defer_size, specific_tags=[Tag(t) for t in tags])
+    return ds, raw.bytes_read
\ No newline at end of file
@@ -1,9 +1,9 @@
 import SimpleITK as sitk
 import numpy as np
-from scipy import ndimage
 from skimage.transform import resize
+from src.preprocessing.dicom_loading import track_bytes
 
-def respacing(img, interp_type, new_spacing): 
+def respacing(img, interp_type, new_spacing, output_origin=None, output_depth=None, output_type=sitk.sitkFloat32): 
     ### calculate new spacing
     old_size = img.GetSize()
     old_spacing = img.GetSpacing()
@@ -13,6 +13,9 @@ def respacing(img, interp_type, new_spacing):
         int(round((old_size[1] * old_spacing[1]) / float(new_spacing[1]))),
         int(round((old_size[2] * old_spacing[2]) / float(new_spacing[2])))
         ]
+    ### only resample a z-window of the output grid (slab mode)
+    if output_depth is not None: new_size[2] = int(output_depth)
+    if output_origin is None: output_origin = img.GetOrigin()
 
     ### choose interpolation algorithm
     if interp_type == 'linear':
@@ -26,34 +29,43 @@ def respacing(img, interp_type, new_spacing):
     resample = sitk.ResampleImageFilter()
     resample.SetOutputSpacing(new_spacing)
     resample.SetSize(new_size)
-    resample.SetOutputOrigin(img.GetOrigin())
+    resample.SetOutputOrigin(output_origin)
     resample.SetOutputDirection(img.GetDirection())
     resample.SetInterpolator(interp_type)
     resample.SetDefaultPixelValue(img.GetPixelIDValue())
-    resample.SetOutputPixelType(sitk.sitkFloat32)
+    resample.SetOutputPixelType(output_type)
     img_nrrd = resample.Execute(img) 
     
     return img_nrrd
 
+def get_slab_window(num_slices, slice_spacing, new_z_spacing, crop_depth, needed_slices):
+    """Map the needed output slices of respacing + crop (mass_centered=False) back to the slices they depend on.
+    Returns (first_respaced, last_respaced, first_source, last_source, first_output) or None if none of the 
+    needed slices lies inside the series."""
+    depth = int(round((num_slices * slice_spacing) / float(new_z_spacing)))
+    startc = int((depth - 1) / 2 - crop_depth//2) #geometric center, as computed in crop_image
+    first = max(0, startc + needed_slices.start)
+    last = min(depth - 1, startc + needed_slices.stop - 1)
+    if first > last: return None
+    # linear interpolation of respaced slice j uses the source slices around j*new_z_spacing/slice_spacing,
+    # one extra slice on each side keeps every sample point strictly inside the decoded slab
+    first_src = max(0, int(np.floor(first * new_z_spacing / slice_spacing)) - 1)
+    last_src = min(num_slices - 1, int(np.floor(last * new_z_spacing / slice_spacing)) + 2)
+    return first, last, first_src, last_src, first - startc
+
 #--------------------------------------------------------------------------------------
 # crop image
 #-------------------------------------------------------------------------------------
-def crop_image(nrrd_file, crop_shape, clipping=None, scale_size=None, verbose=False, mass_centered=False):
+def crop_image(nrrd_file, crop_shape, clipping=None, scale_size=None, verbose=False, mass_centered=False, mass_downsample=1, memory=None):
+    """Crop (and scale) the image. memory (see dicom_loading.new_memory) counts the intermediate arrays and the result."""
     print_lines = []
-    ## load stik and arr
-    img_arr = sitk.GetArrayFromImage(nrrd_file)
-    if clipping:
-        img_arr[img_arr<clipping] = clipping
-        img_arr[img_arr>700] = 0
+    ## read-only view on the image, only the crop window is copied
+    img_arr = sitk.GetArrayViewFromImage(nrrd_file)
     c, y, x = img_arr.shape
     x_crop, y_crop, c_crop = crop_shape
     
     ## Get center of mass to center the crop in Y plane
-    mask_arr = np.copy(img_arr) 
-    mask_arr[mask_arr > -500] = 1
-    mask_arr[mask_arr <= -500] = 0
-    if not mass_centered: mask_arr[mask_arr >= -500] = 1
-    centermass = ndimage.measurements.center_of_mass(mask_arr)
+    centermass = get_crop_center(img_arr, clipping=clipping, mass_centered=mass_centered, downsample=mass_downsample)
     print_lines.append("Center of mass: "+str(centermass))
     startc = int(centermass[0] - c_crop//2)
     starty = int(centermass[1] - y_crop//2)      
@@ -66,7 +78,7 @@ def crop_image(nrrd_file, crop_shape, clipping=None, scale_size=None, verbose=Fa
     print_lines.append(str(starty) + " : "+str(starty + y_crop))
     print_lines.append(str(startx) + " : "+str(startx + x_crop))
 
-    # Check for out-of-bound scenarios and apply padding if needed
+    # Check for out-of-bound scenarios, padding is only applied to the crop window
     pad_c_before = -min(0, startc)
     pad_c_after = max(0, startc + c_crop - c)
     pad_y_before = -min(0, starty)
@@ -78,40 +90,145 @@ def crop_image(nrrd_file, crop_shape, clipping=None, scale_size=None, verbose=Fa
     if any([pad_c_before, pad_c_after, pad_y_before, pad_y_after, pad_x_before, pad_x_after]):
         print_lines.append(f"Applying padding. Before: {(pad_c_before, pad_y_before, pad_x_before)}, After: {(pad_c_after, pad_y_after, pad_x_after)}")
     a = (-1000.0)
-    # Apply padding
-    img_arr_padded = np.pad(
-        img_arr, 
-        ((pad_c_before, pad_c_after), (pad_y_before, pad_y_after), (pad_x_before, pad_x_after)), 
-        'constant', 
-        constant_values=((a, a), (a, a), (a, a))
-    )
-    # Update start indices after padding
-    startc += pad_c_before
-    starty += pad_y_before
-    startx += pad_x_before
-
-    img_crop_arr = img_arr_padded[
-        startc:(startc + c_crop),
-        starty:(starty + y_crop),
-        startx:(startx + x_crop)
-    ]
+    img_crop_arr = np.full((c_crop, y_crop, x_crop), a, dtype=img_arr.dtype)
+    track_bytes(memory, img_crop_arr.nbytes)
+    # part of the crop window that lies inside the image (empty if the window misses the image completely)
+    src = tuple(slice(max(0, start), max(0, min(n, start + n_crop))) for start, n, n_crop in [(startc, c, c_crop), (starty, y, y_crop), (startx, x, x_crop)])
+    dst = tuple(slice(s.start - start, s.stop - start) if s.stop > s.start else slice(0, 0) for s, start in zip(src, (startc, starty, startx)))
+    window = img_crop_arr[dst]
+    window[...] = img_arr[src]
+    if clipping: #clip only the image values, the padding stays at -1000
+        np.maximum(window, clipping, out=window)
+        window[window>700] = 0
 
     print_lines.append("Image shape after cropping: "+str(img_crop_arr.shape))
     if scale_size is not None:
-        img_crop_arr = scale_image(img_crop_arr=img_crop_arr, scale_size=scale_size)
+        img_scaled_arr = scale_image(img_crop_arr=img_crop_arr, scale_size=scale_size, memory=memory)
+        track_bytes(memory, -img_crop_arr.nbytes)
+        img_crop_arr = img_scaled_arr
         print_lines.append("Image shape after scaling: "+str(img_crop_arr.shape))
 
     img_crop_nrrd = sitk.GetImageFromArray(img_crop_arr)
     img_crop_nrrd.SetSpacing(nrrd_file.GetSpacing())
     img_crop_nrrd.SetOrigin(nrrd_file.GetOrigin())
+    track_bytes(memory, img_crop_arr.nbytes) #the sitk copy replaces the array once this function returns
+    track_bytes(memory, -img_crop_arr.nbytes)
 
     for line in print_lines:
         if verbose: print(line)
     
     return img_crop_nrrd
-    
-def scale_image(img_crop_arr, scale_size):
+
+def get_crop_center(img_arr, clipping=None, mass_centered=False, downsample=1):
+    """Centre (c, y, x) of the crop window without materializing a mask volume.
+    By default this is the geometric centre. With mass_centered, it is the centre of mass of all voxels above -500 HU 
+    (after clipping), accumulated slice by slice from axis projections, optionally on a grid downsampled by an integer factor."""
+    if not mass_centered or (clipping and clipping > -500): #clipping above -500 puts every voxel into the mask
+        return tuple((n - 1) / 2 for n in img_arr.shape)
+    counts = [np.zeros(n) for n in img_arr.shape]
+    for z in range(0, img_arr.shape[0], downsample):
+        mask = img_arr[z, ::downsample, ::downsample] > -500 #values set to 0 by the >700 clipping stay above -500
+        counts[0][z] = mask.sum()
+        counts[1][::downsample] += mask.sum(axis=1)
+        counts[2][::downsample] += mask.sum(axis=0)
+    total = counts[0].sum()
+    if total == 0: raise Exception("No voxels above -500 HU found to center the crop on.")
+    return tuple(float(np.dot(np.arange(len(count)), count) / total) for count in counts)
+
+def scale_image(img_crop_arr, scale_size, memory=None):
     # Assuming scale_size is a tuple (new_x, new_y)
     new_size = (img_crop_arr.shape[0], scale_size[0], scale_size[1])
+    resize_bytes, work_bytes = get_scale_bytes(img_crop_arr.shape, img_crop_arr.dtype, scale_size)
+    track_bytes(memory, resize_bytes)
+    track_bytes(memory, work_bytes - resize_bytes)
     img_crop_arr_scaled = resize(img_crop_arr, new_size, mode='constant', anti_aliasing=True, preserve_range=True)
-    return img_crop_arr_scaled.astype(img_crop_arr.dtype)
\ No newline at end of file
+    img_crop_arr_scaled = img_crop_arr_scaled.astype(img_crop_arr.dtype)
+    track_bytes(memory, img_crop_arr_scaled.nbytes)
+    track_bytes(memory, -work_bytes)
+    return img_crop_arr_scaled
+
+def get_scale_bytes(shape, dtype, scale_size):
+    """Bytes held by resize in scale_image for an input of the given shape and dtype: (peak, result before the astype).
+    Float input is resized in its own dtype, any other in float64, which needs a converted copy of the input.
+    The anti-aliasing filter writes another copy of the input, the interpolation the result."""
+    dtype = np.dtype(dtype)
+    work = dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+    in_voxels = int(np.prod(shape))
+    out_bytes = shape[0] * scale_size[0] * scale_size[1] * work.itemsize
+    antialiased = scale_size[0] < shape[1] or scale_size[1] < shape[2]
+    peak = (in_voxels * work.itemsize if work != dtype else 0) + (in_voxels * work.itemsize if antialiased else 0) + out_bytes
+    return peak, out_bytes
+
+#--------------------------------------------------------------------------------------
+# fused respacing + crop + scale
+#-------------------------------------------------------------------------------------
+def fused_transform(img, new_spacing, crop_shape, scale_size, clipping=-1000, upper_clip=700, 
+                    source_size=None, source_origin=None, out_slices=None, output_type=sitk.sitkFloat32, memory=None):
+    """Respacing and geometric-centre crop (mass_centered=False) in one resampling pass, followed by the clipping and 
+    in-plane scaling of crop_image. The output grid of the resampling is the crop window (crop_shape, 200x200x100) of 
+    the respaced grid, so the full respaced volume and the copy of its crop window are never materialized. The scaling 
+    to scale_size is not fused: scale_image resamples the window a second time, exactly as in crop_image. Every voxel is 
+    sampled at the same point with the same interpolation, so the result equals respacing + crop_image + scale_image 
+    (see check_fused_equivalence). With an integer output_type, values can differ by 1 where the interpolated value 
+    lies on an integer, as the sample coordinates are accumulated from a different grid start.
+    source_size / source_origin describe the full series if img is only a z-slab of it, out_slices restricts the 
+    result to these output slices."""
+    if source_size is None: source_size = img.GetSize()
+    if source_origin is None: source_origin = img.GetOrigin()
+    spacing = img.GetSpacing()
+    resp_size = [int(round((source_size[i] * spacing[i]) / float(new_spacing[i]))) for i in range(3)]
+    start = [int((resp_size[i] - 1) / 2 - crop_shape[i]//2) for i in range(3)] #same crop window as crop_image
+    window_size = list(crop_shape)
+    if out_slices is not None: #scale_image does not touch the depth, so output slices are slices of the crop window
+        start[2] += out_slices.start
+        window_size[2] = len(out_slices)
+    direction = np.array(img.GetDirection(), dtype=float).reshape(3, 3)
+    window_origin = np.array(source_origin, dtype=float) + direction @ (np.array(new_spacing, dtype=float) * np.array(start))
+
+    resample = sitk.ResampleImageFilter()
+    resample.SetOutputSpacing(new_spacing)
+    resample.SetSize([int(s) for s in window_size])
+    resample.SetOutputOrigin([float(o) for o in window_origin])
+    resample.SetOutputDirection(img.GetDirection())
+    resample.SetInterpolator(sitk.sitkLinear)
+    resample.SetDefaultPixelValue(img.GetPixelIDValue()) #as in respacing
+    resample.SetOutputPixelType(output_type) #as in respacing
+    window_image = resample.Execute(img)
+    window = sitk.GetArrayFromImage(window_image)
+    del window_image
+    track_bytes(memory, 2*window.nbytes) #the resampled image and its array copy
+    track_bytes(memory, -window.nbytes)
+
+    # clipping as in crop_image, after the interpolation
+    np.maximum(window, clipping, out=window)
+    window[window>upper_clip] = 0
+    # the parts of the window outside of the respaced grid are the crop padding
+    for axis, (first, size) in enumerate(zip(start[::-1], resp_size[::-1])):
+        index = [slice(None)] * 3
+        index[axis] = slice(0, max(0, min(window.shape[axis], -first)))
+        window[tuple(index)] = clipping
+        index[axis] = slice(max(0, size - first), None)
+        window[tuple(index)] = clipping
+
+    scaled = scale_image(img_crop_arr=window, scale_size=scale_size, memory=memory)
+    track_bytes(memory, -window.nbytes)
+    del window
+    img_fused = sitk.GetImageFromArray(scaled)
+    track_bytes(memory, scaled.nbytes) #the sitk copy replaces the array once this function returns
+    track_bytes(memory, -scaled.nbytes)
+    # same metadata as the three-step path (crop_image keeps the respaced spacing and origin)
+    img_fused.SetSpacing(new_spacing)
+    img_fused.SetOrigin(source_origin)
+    return img_fused
+
+def check_fused_equivalence(img, new_spacing, crop_shape, scale_size, clipping=-1000, output_type=sitk.sitkFloat32, atol=None):
+    """Compare fused_transform against respacing + crop_image + scale_image on one series.
+    Passes if every voxel differs by at most atol HU. By default, atol only allows float rounding for float32 output 
+    and the 1 HU truncation difference for integer output."""
+    if atol is None: atol = 1e-3 if output_type == sitk.sitkFloat32 else 1
+    respaced = respacing(img, interp_type='linear', new_spacing=new_spacing, output_type=output_type)
+    reference = sitk.GetArrayFromImage(crop_image(respaced, crop_shape=crop_shape, clipping=clipping, scale_size=scale_size, mass_centered=False))
+    del respaced
+    fused = sitk.GetArrayFromImage(fused_transform(img, new_spacing, crop_shape, scale_size, clipping=clipping, output_type=output_type))
+    diff = np.abs(fused.astype(np.float64) - reference)
+    return {"max_abs_diff": float(diff.max()), "mean_abs_diff": float(diff.mean()), "passed": bool(diff.max() <= atol)}
@@ -0,0 +1,163 @@
+import time
+import multiprocessing
+import numpy as np
+import SimpleITK as sitk
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from src.preprocessing.preprocess_series import preprocess_series, CROP_SHAPE, SCALE_SIZE
+
+#Upper bound of the size of a preprocessed volume: crop depth x scaled rows x cols, at most 8 bytes per voxel
+SLOT_BYTES = CROP_SHAPE[2] * SCALE_SIZE[0] * SCALE_SIZE[1] * 8
+
+def preprocess_to_shared_memory(series_info, out_directory, slot_name=None, verbose=False, options=None):
+    """Worker: preprocess one series and write the volume into the shared memory block slot_name of the main process 
+    instead of pickling it. Returns a small description of the result, or None if preprocessing failed."""
+    img = preprocess_series(series_info=series_info, out_directory=out_directory, verbose=verbose, **(options or {}))
+    if img is None: return None
+    if not isinstance(img, sitk.Image): return ("object", img) #e.g. a StoredVolume handle, which is only a reference
+    arr = sitk.GetArrayViewFromImage(img)
+    if slot_name is None or arr.nbytes > SLOT_BYTES: #no free block (or an unexpected size), the volume is pickled
+        return ("array", np.array(arr), list(img.GetSpacing()), list(img.GetOrigin()))
+    shm = shared_memory.SharedMemory(name=slot_name)
+    try: np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    finally: shm.close() #the main process keeps its own handle open, so the block stays alive on every platform
+    return ("shared", slot_name, arr.shape, arr.dtype.str, list(img.GetSpacing()), list(img.GetOrigin()))
+
+class SharedSlots:
+    """Fixed set of shared memory blocks created and owned by the main process, each holding one preprocessed volume.
+    Workers only attach to a block to write into it: on Windows a block is freed as soon as its last handle is closed,
+    so a block created by a worker would be gone before the main process could open it."""
+    def __init__(self, count, size=SLOT_BYTES):
+        self.blocks = {}
+        for _ in range(count):
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            self.blocks[shm.name] = shm
+        self.free = list(self.blocks)
+
+    def acquire(self):
+        return self.free.pop() if self.free else None
+
+    def release(self, name):
+        if name in self.blocks and name not in self.free: self.free.append(name)
+
+    def close(self):
+        for shm in self.blocks.values():
+            try: shm.close()
+            except BufferError: pass #an array still points into the block, it is freed once that is gone
+            shm.unlink()
+        self.blocks = {}
+        self.free = []
+
+class SharedVolume:
+    """Preprocessed volume in one of the shared memory blocks of SharedSlots (read without copying). release() hands
+    the block back for the next series."""
+    def __init__(self, slots, name, shape, dtype, spacing, origin):
+        self.slots = slots
+        self.name = name
+        self.array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=slots.blocks[name].buf)
+        self.spacing = spacing
+        self.origin = origin
+
+    def read_slices(self, slice_range):
+        return self.array[slice_range.start:slice_range.stop]
+
+    def release(self):
+        self.array = None
+        self.slots.release(self.name)
+
+def open_result(result, slots):
+    """Turn the result description of a worker into a volume (None stays None)."""
+    if result is None: return None
+    if result[0] == "object": return result[1]
+    if result[0] == "array":
+        img = sitk.GetImageFromArray(result[1])
+        img.SetSpacing(result[2])
+        img.SetOrigin(result[3])
+        return img
+    return SharedVolume(slots, *result[1:])
+
+class ProcessPoolPrefetcher:
+    """Preprocesses the series of a to-do list in a pool of worker processes, keeping at most depth series ahead of
+    the one currently requested. Results are handed out strictly in list order. If a worker process dies (e.g. a
+    decoder crash on a corrupt series), the affected series is retried alone and reported as failed (None) if it
+    crashes again, while the pool is rebuilt for all other series."""
+    def __init__(self, to_do, workers, depth, out_directory, verbose=False, options=None):
+        self.series = [series.to_dict() for _, series in to_do.iterrows()]
+        self.workers = workers
+        self.depth = max(depth, workers)
+        self.out_directory = out_directory
+        self.verbose = verbose
+        self.options = options or {}
+        #spawned workers behave the same on every platform and do not inherit the Tk, model loading and ITK threads
+        self.context = multiprocessing.get_context("spawn")
+        self.executor = self.new_executor(workers)
+        #one block per queued series, plus the one currently handed out
+        self.slots = SharedSlots(self.depth + 2)
+        self.pending = {} #position -> (future, name of its shared memory block)
+
+    def new_executor(self, workers):
+        return ProcessPoolExecutor(max_workers=workers, mp_context=self.context)
+
+    def submit(self, executor, position, slot_name):
+        return executor.submit(preprocess_to_shared_memory, self.series[position], self.out_directory, slot_name=slot_name,
+                               verbose=self.verbose, options=self.options)
+
+    def submit_until(self, position):
+        for j in range(position, min(position + self.depth + 1, len(self.series))):
+            if j in self.pending: continue
+            slot_name = self.slots.acquire()
+            if slot_name is None and j > position: break #submitted once a block is handed back
+            self.pending[j] = (self.submit(self.executor, j, slot_name), slot_name)
+
+    def get(self, position, wait_callback=None):
+        """Return the preprocessed volume of the series at position (None if preprocessing failed)."""
+        self.submit_until(position)
+        future, slot_name = self.pending.pop(position)
+        self.wait(future, wait_callback)
+        try:
+            result = future.result()
+        except BrokenProcessPool:
+            result = self.retry_isolated(position, slot_name, wait_callback)
+        except Exception as e:
+            if self.verbose: print(f"Preprocessing worker failed for series {self.series[position]['Index']}: {e}")
+            result = None
+        try:
+            volume = open_result(result, self.slots)
+        except Exception as e:
+            if self.verbose: print(f"The preprocessed volume of series {self.series[position]['Index']} could not be opened: {e}")
+            volume = None
+        if not isinstance(volume, SharedVolume): self.slots.release(slot_name) #the block was not used
+        self.submit_until(position + 1)
+        return volume
+
+    def retry_isolated(self, position, slot_name, wait_callback=None):
+        """Rebuild the pool after a worker died and re-run the series at position in a process of its own."""
+        if self.verbose: print(f"A preprocessing worker died, retrying series {self.series[position]['Index']} in isolation.")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.new_executor(self.workers)
+        for _, pending_slot in self.pending.values(): self.slots.release(pending_slot)
+        self.pending = {} #all queued futures belonged to the broken pool, they are resubmitted on demand
+        single = self.new_executor(1)
+        try:
+            future = self.submit(single, position, slot_name)
+            self.wait(future, wait_callback)
+            return future.result()
+        except Exception as e:
+            if self.verbose: print(f"Series {self.series[position]['Index']} could not be preprocessed: {e}")
+            return None
+        finally:
+            single.shutdown(wait=False)
+
+    def wait(self, future, wait_callback=None):
+        from src.user_interface.ui_utils import wait_for_future #imported here, the spawned workers do not need Tk
+        try: wait_for_future(future, wait_callback)
+        except Exception: pass #the result is collected (and its error handled) by the caller
+
+    def stop(self):
+        """Drop all prefetched results and free the shared memory. Workers still running fail to attach to or write
+        into the freed blocks, their results are ignored."""
+        for future, _ in self.pending.values(): future.cancel()
+        self.pending = {}
+        self.executor.shutdown(wait=False)
+        self.slots.close()
@@ -1,43 +1,185 @@
 import os
-import glob
 import numpy as np
 import SimpleITK as sitk
-from src.preprocessing.dicom_loading import get_sitk_from_dicom
-from src.preprocessing.image_transformation import respacing, crop_image
+from src.preprocessing.dicom_loading import (get_sitk_from_dicom, get_dicom_slices, slices_to_sitk, get_hu_volume, volume_to_sitk, is_dicom_file, 
+                                             get_series_files, read_tags, new_memory, track_bytes)
+from src.preprocessing.image_transformation import respacing, crop_image, get_slab_window, fused_transform, get_scale_bytes, check_fused_equivalence
+from src.preprocessing.volume_cache import get_preprocessed_key, record_cache_access, get_tmp_path
+from src.preprocessing.volume_store import StoredVolume, has_volume, write_volume, STORE_FILE
+from src.prediction.get_probabilities import HN_SLICE_RANGE, CH_SLICE_RANGE, AB_SLICE_RANGE, BP_SLICE_RANGE
 
 CROP_SHAPE = [200, 200, 100]
 SCALE_SIZE = [150,150,100]
+NEW_SPACING = (1, 1, 3)
+#Everything that changes the content of a preprocessed volume, hashed into its cache key (with the options of a run,
+#see preprocess_series)
+PREPROCESSING_PARAMS = {"crop_shape": CROP_SHAPE, "scale_size": SCALE_SIZE, "spacing": NEW_SPACING, 
+                        "interpolation": "linear", "clipping": -1000, "mass_centered": False}
 
-def preprocess_series(series_info, out_directory=None, verbose=False, save_nrrds=False, dicoms_by_ending=True):
-    pre_dir = os.path.join(out_directory, "preprocessed")
-    file_dir = os.path.join(pre_dir, str(series_info["Index"])+".nrrd")
+#Output slices that are read by any of the models (normalization slabs include the predicted slices)
+NEEDED_SLICES = range(min(r.start for r in [HN_SLICE_RANGE, CH_SLICE_RANGE, AB_SLICE_RANGE, BP_SLICE_RANGE]),
+                      max(r.stop for r in [HN_SLICE_RANGE, CH_SLICE_RANGE, AB_SLICE_RANGE, BP_SLICE_RANGE]))
+
+def preprocess_series(series_info, out_directory=None, verbose=False, save_nrrds=False, dicoms_by_ending=True, decode_workers=1, slab_mode=False, 
+                      volume_cache_dir=None, preprocessed_dir=None, storage="nrrd", fused=False, reduced_precision=False, memory_budget=None):
+    pre_dir = preprocessed_dir or os.path.join(out_directory, "preprocessed")
     #if not os.path.exists(pre_dir): os.makedirs(pre_dir)
 
     try:
+        #content-addressed: the file name only depends on the series, its files and the preprocessing parameters
+        params = dict(PREPROCESSING_PARAMS)
+        #the fused path gives the same float32 volume and shares its key, int16 values can differ by 1 HU (truncation)
+        if fused and reduced_precision: params["fused"] = True
+        if reduced_precision: params["reduced_precision"] = True
+        params["dcm_ending"] = bool(dicoms_by_ending) #decides which files of the directory are the input slices
+        #exact file list if the listing found several series in the directory, else None (all files of the directory)
+        series_files = series_info.get("Series Files")
+        files = get_series_files(series_info["Series Directory"], series_files) if isinstance(series_files, str) and series_files else None
+        key = get_preprocessed_key(series_info["Series Instance UID"], get_series_files(series_info["Series Directory"], series_files), params)
+        file_dir = os.path.join(pre_dir, key + ".nrrd")
+        if storage == "store" and has_volume(pre_dir, key):
+            if verbose: print("Using existing volume from the preprocessed store")
+            record_cache_access(pre_dir, key, hit=True)
+            return StoredVolume(pre_dir, key) #slices are only read when the prediction needs them
         if os.path.exists(file_dir):
             if verbose: print("Loading existing file")
             sitk_object = sitk.ReadImage(file_dir)
+            record_cache_access(pre_dir, key, hit=True)
             return sitk_object
         if verbose: print("No preprocessed file exists for this series, initiating preprocessing:")
-        sitk_object = get_sitk_from_dicom(series_info["Series Directory"], verbose=verbose, by_ending=dicoms_by_ending)
+        use_slab = slab_mode and not save_nrrds #stored NRRD files always hold the full volume
+        if not use_slab and memory_budget:
+            planned_bytes = estimate_peak_bytes(series_info["Series Directory"], by_ending=dicoms_by_ending, reduced_precision=reduced_precision, files=files)
+            if verbose: print(f"Planned peak memory: {planned_bytes/2**20:.1f} MB (budget: {memory_budget/2**20:.1f} MB)")
+            if planned_bytes > memory_budget:
+                if verbose: print("Series exceeds the memory budget, falling back to slab-wise preprocessing (no preprocessed file is stored).")
+                use_slab, save_nrrds = True, False
+        #bytes held by the arrays of each stage (decoding buffers, sitk copies, resampling, crop and resize buffers)
+        memory = new_memory()
+        if use_slab:
+            cropped_object = preprocess_slab(series_info["Series Directory"], NEEDED_SLICES, verbose=verbose, by_ending=dicoms_by_ending, 
+                                             decode_workers=decode_workers, cache_dir=volume_cache_dir, series_uid=series_info["Series Instance UID"], 
+                                             fused=fused, reduced_precision=reduced_precision, files=files, memory=memory)
+            if verbose: print(f"Peak memory of this series: {memory['peak']/2**20:.1f} MB")
+            if verbose: print("Preprocessing finished.")
+            return cropped_object
+        sitk_object = get_sitk_from_dicom(series_info["Series Directory"], verbose=verbose, by_ending=dicoms_by_ending, num_workers=decode_workers,
+                                          cache_dir=volume_cache_dir, series_uid=series_info["Series Instance UID"], files=files, memory=memory)
+        volume_bytes = sitk.GetArrayViewFromImage(sitk_object).nbytes
         if verbose: print("Loaded sitk object, initiating respacing and cropping...")
-        respaced_object = respacing(sitk_object, interp_type='linear',new_spacing=(1, 1, 3))
-        cropped_object = crop_image(respaced_object, crop_shape=CROP_SHAPE, clipping=-1000, 
-                                    scale_size=SCALE_SIZE, verbose=verbose, mass_centered=False)
+        if fused:
+            if verbose: #runs the three-step path as well, its arrays are not counted in the peak memory below
+                check = check_fused_equivalence(sitk_object, NEW_SPACING, CROP_SHAPE, SCALE_SIZE, clipping=-1000, 
+                                                output_type=sitk.sitkInt16 if reduced_precision else sitk.sitkFloat32)
+                print(f"Fused transform {'matches' if check['passed'] else 'DIFFERS FROM'} the three-step path (max difference {check['max_abs_diff']:g} HU)")
+            cropped_object = fused_transform(sitk_object, NEW_SPACING, CROP_SHAPE, SCALE_SIZE, clipping=-1000,
+                                             output_type=sitk.sitkInt16 if reduced_precision else sitk.sitkFloat32, memory=memory)
+            del sitk_object
+            track_bytes(memory, -volume_bytes)
+        else:
+            respaced_object = respacing(sitk_object, interp_type='linear',new_spacing=NEW_SPACING, 
+                                        output_type=sitk.sitkInt16 if reduced_precision else sitk.sitkFloat32)
+            respaced_bytes = sitk.GetArrayViewFromImage(respaced_object).nbytes
+            track_bytes(memory, respaced_bytes)
+            del sitk_object #free each stage's input as soon as the next stage has consumed it
+            track_bytes(memory, -volume_bytes)
+            cropped_object = crop_image(respaced_object, crop_shape=CROP_SHAPE, clipping=-1000,
+                                        scale_size=SCALE_SIZE, verbose=verbose, mass_centered=False, memory=memory)
+            del respaced_object
+            track_bytes(memory, -respaced_bytes)
+        if verbose: print(f"Peak memory of this series: {memory['peak']/2**20:.1f} MB")
         if verbose: print("Preprocessing finished.")
-        if save_nrrds:
+        if save_nrrds and storage == "store":
+            write_volume(pre_dir, key, cropped_object, series_uid=series_info["Series Instance UID"])
+            record_cache_access(pre_dir, key, hit=False, series_uid=series_info["Series Instance UID"], location=STORE_FILE)
+            if verbose: print("Saved scan " + str(series_info["Index"]) + " to " + os.path.join(pre_dir, STORE_FILE))
+        elif save_nrrds:
+            tmp_dir = get_tmp_path(file_dir)
             nrrdWriter = sitk.ImageFileWriter()
-            nrrdWriter.SetFileName(file_dir)
+            nrrdWriter.SetFileName(tmp_dir)
             nrrdWriter.SetUseCompression(True)
             nrrdWriter.Execute(cropped_object)
+            os.replace(tmp_dir, file_dir)
+            record_cache_access(pre_dir, key, hit=False, series_uid=series_info["Series Instance UID"])
             if verbose: print("Saved "+str(file_dir)+" for scan " + str(series_info["Index"]))
     except Exception as e:
-        if verbose: 
+        if verbose:
             print("The following error appeared during preprocessing of this series:")
             print(e)
         return None
     return cropped_object
 
+def preprocess_slab(dicom_dir, needed_slices, verbose=False, by_ending=True, decode_workers=1, cache_dir=None, series_uid=None, fused=False, 
+                    reduced_precision=False, files=None, memory=None):
+    """Preprocess only the source slices that end up in the needed output slices.
+    Within needed_slices the result equals the full path, all other output slices are filled with -1000.
+    memory (see dicom_loading.new_memory) counts the arrays of all stages."""
+    if cache_dir: #the cached volume is a memmap, so only the slab is actually read
+        volume, img_spacing, img_direction, img_origin = get_hu_volume(dicom_dir, series_uid, cache_dir, verbose=verbose, 
+                                                                       by_ending=by_ending, num_workers=decode_workers, files=files)
+        num_slices = volume.shape[0]
+    else:
+        slices, img_spacing, img_direction, img_origin = get_dicom_slices(dicom_dir, verbose=verbose, by_ending=by_ending, defer_pixels=True, files=files)
+        num_slices = len(slices)
+    window = get_slab_window(num_slices, img_spacing[2], NEW_SPACING[2], CROP_SHAPE[2], needed_slices)
+    out_arr = np.full((CROP_SHAPE[2], SCALE_SIZE[0], SCALE_SIZE[1]), -1000.0, dtype=np.float32)
+    track_bytes(memory, out_arr.nbytes)
+    if window is not None:
+        first, last, first_src, last_src, first_out = window
+        if verbose: print(f"Slab mode: using source slices {first_src}-{last_src} of {num_slices} for output slices {first_out}-{first_out + last - first}")
+        z_axis = np.array(img_direction, dtype=float).reshape(3, 3)[:, 2]
+        src_origin = [float(o) for o in np.array(img_origin) + z_axis * img_spacing[2] * first_src]
+        out_origin = [float(o) for o in np.array(img_origin) + z_axis * NEW_SPACING[2] * first]
+        if cache_dir: sitk_object = volume_to_sitk(volume[first_src:last_src + 1], img_spacing, img_direction, src_origin, memory=memory)
+        else: sitk_object = slices_to_sitk(slices[first_src:last_src + 1], img_spacing, img_direction, src_origin,
+                                           verbose=verbose, num_workers=decode_workers, memory=memory)
+        slab_bytes = sitk.GetArrayViewFromImage(sitk_object).nbytes
+        if fused:
+            cropped_slab = fused_transform(sitk_object, NEW_SPACING, CROP_SHAPE, SCALE_SIZE, clipping=-1000, 
+                                           source_size=sitk_object.GetSize()[:2] + (num_slices,), source_origin=img_origin, 
+                                           out_slices=range(first_out, first_out + last - first + 1), 
+                                           output_type=sitk.sitkInt16 if reduced_precision else sitk.sitkFloat32, memory=memory)
+            del sitk_object
+            track_bytes(memory, -slab_bytes)
+        else:
+            respaced_object = respacing(sitk_object, interp_type='linear', new_spacing=NEW_SPACING,
+                                        output_origin=out_origin, output_depth=last - first + 1, 
+                                        output_type=sitk.sitkInt16 if reduced_precision else sitk.sitkFloat32)
+            respaced_bytes = sitk.GetArrayViewFromImage(respaced_object).nbytes
+            track_bytes(memory, respaced_bytes)
+            del sitk_object
+            track_bytes(memory, -slab_bytes)
+            #the slab is already the z-window of the crop, so only the in-plane crop and scaling are applied here
+            cropped_slab = crop_image(respaced_object, crop_shape=[CROP_SHAPE[0], CROP_SHAPE[1], last - first + 1], clipping=-1000,
+                                      scale_size=SCALE_SIZE, verbose=verbose, mass_centered=False, memory=memory)
+            del respaced_object
+            track_bytes(memory, -respaced_bytes)
+        out_arr[first_out:first_out + last - first + 1] = sitk.GetArrayViewFromImage(cropped_slab)
+        track_bytes(memory, -sitk.GetArrayViewFromImage(cropped_slab).nbytes)
+        del cropped_slab
+    cropped_object = sitk.GetImageFromArray(out_arr)
+    cropped_object.SetSpacing(NEW_SPACING)
+    cropped_object.SetOrigin(img_origin)
+    track_bytes(memory, out_arr.nbytes) #the sitk copy replaces the array once this function returns
+    track_bytes(memory, -out_arr.nbytes)
+    return cropped_object
 
-
-
+def estimate_peak_bytes(dicom_dir, by_ending=True, reduced_precision=False, files=None):
+    """Estimate the peak memory of the full preprocessing path from the number of DICOM files and one DICOM header.
+    Follows the stages counted in preprocess_series (uncompressed PixelData assumed)."""
+    all_files = sorted(files) if files is not None else get_series_files(dicom_dir)
+    dicom_files = [file for file in all_files if is_dicom_file(file, by_ending=by_ending)]
+    if not dicom_files: return 0
+    ds, _ = read_tags(dicom_files[0], ["SliceThickness", "Rows", "Columns", "PixelSpacing"], stop_after="PixelSpacing")
+    rows, cols = int(ds.Rows), int(ds.Columns)
+    pixel_spacing = [float(p) for p in ds.PixelSpacing]
+    thickness = float(getattr(ds, "SliceThickness", None) or NEW_SPACING[2])
+    volume_bytes = len(dicom_files) * rows * cols * 2 #int16 HU volume
+    itemsize = 2 if reduced_precision else 4
+    respaced_voxels = (round(cols * pixel_spacing[1] / NEW_SPACING[0]) * round(rows * pixel_spacing[0] / NEW_SPACING[1]) 
+                       * round(len(dicom_files) * thickness / NEW_SPACING[2]))
+    respaced_bytes = respaced_voxels * itemsize
+    crop_bytes = CROP_SHAPE[2] * CROP_SHAPE[1] * CROP_SHAPE[0] * itemsize
+    resize_bytes, _ = get_scale_bytes((CROP_SHAPE[2], CROP_SHAPE[1], CROP_SHAPE[0]), np.int16 if reduced_precision else np.float32, SCALE_SIZE)
+    #decoding: volume + raw PixelData, then volume + sitk copy; respacing: sitk volume + respaced; crop_image: respaced + crop + resize
+    return max(2*volume_bytes, volume_bytes + respaced_bytes, respaced_bytes + crop_bytes + resize_bytes)
@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import hashlib
+import sqlite3
+import threading
+
+INDEX_FILE = "scan_index.sqlite"
+CHECKPOINT_INTERVAL = 200 #directories, new scan results are committed in batches of this size
+
+def get_default_index_dir(directory):
+    """Per-user location of the scan index of a listed directory. It is kept outside of the output folder, which a 
+    reset deletes, so re-listing a directory after a reset still only scans what changed."""
+    if sys.platform == "win32": base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    elif sys.platform == "darwin": base = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+    else: base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    key = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:16]
+    return os.path.join(base, "FALCON", "scan_index", key)
+
+class ScanIndex:
+    """Persistent index of the series listing: per directory its modification time and what scan_directory found there.
+    A directory only has to be scanned again if its mtime changed (i.e. entries were added, removed or renamed).
+    Results are stored per scan mode, as they depend on the listing settings.
+    New results are committed regularly, so an interrupted listing resumes from the directories already scanned.
+    Lookups can be done from several threads, adding and checkpointing only from the thread that owns the index."""
+    def __init__(self, index_dir, mode=""):
+        os.makedirs(index_dir, exist_ok=True)
+        self.path = os.path.join(index_dir, INDEX_FILE)
+        self.mode = mode
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.pending = []
+        self.connection().execute("""CREATE TABLE IF NOT EXISTS directory_scans (path TEXT, mode TEXT, mtime_ns INTEGER,
+                                     subdirs TEXT, series TEXT, PRIMARY KEY (path, mode))""")
+        self.connection().commit()
+
+    def connection(self):
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            with self.lock: self.connections.append(self.local.conn)
+        return self.local.conn
+
+    def lookup(self, path, mtime_ns):
+        """Return the stored (subdirs, series) of a directory, or None if it is unknown or has changed."""
+        row = self.connection().execute("SELECT subdirs, series FROM directory_scans WHERE path=? AND mode=? AND mtime_ns=?",
+                                        (path, self.mode, mtime_ns)).fetchone()
+        if row is None: return None
+        subdirs, series = row
+        return json.loads(subdirs), [tuple(s) for s in json.loads(series)]
+
+    def add(self, path, mtime_ns, result):
+        subdirs, series = result
+        self.pending.append((path, self.mode, mtime_ns, json.dumps(subdirs), json.dumps(series, default=str)))
+        if len(self.pending) >= CHECKPOINT_INTERVAL: self.checkpoint()
+
+    def checkpoint(self):
+        if not self.pending: return
+        conn = self.connection()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO directory_scans VALUES (?, ?, ?, ?, ?)", self.pending)
+        self.pending = []
+
+    def close(self):
+        self.checkpoint()
+        for conn in self.connections: conn.close()
+        self.connections = []
+
+def scan_directory_indexed(path, scan_function, index):
+    """Run scan_function(path), which returns (subdirs, series, complete), unless the index holds a result for the 
+    unchanged directory. Returns ((subdirs, series), mtime_ns), mtime_ns is None if nothing has to be added to the 
+    index: the result came from the index, or the scan was incomplete and has to be repeated next time."""
+    try: mtime_ns = os.stat(path).st_mtime_ns #taken before the scan: a change during the scan leads to a rescan next time
+    except OSError: return scan_function(path)[:2], None
+    result = index.lookup(path, mtime_ns)
+    if result is not None: return result, None
+    subdirs, series, complete = scan_function(path)
+    return (subdirs, series), mtime_ns if complete else None
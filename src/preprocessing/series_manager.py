@@ -1,82 +1,241 @@
 import os
 import csv
-import pydicom
+import json
+import numpy as np
 import pandas as pd
 import time
+import queue
+import threading
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 from src.user_interface.ui_utils import update_start_button, update_reset_button
-from src.preprocessing.dicom_loading import is_dicom_file
+from src.preprocessing.dicom_loading import read_tags, SERIES_FILES_SEPARATOR
+from src.preprocessing.scan_index import ScanIndex, scan_directory_indexed, get_default_index_dir
 
-def create_series_df(app, min_dcm_files):
-    """Traverse the given directory and collect series information."""
+SERIES_COLUMNS = ["Index", "Patient ID", "Study Instance UID", "Series Instance UID", "Study Description", "Series Description",
+                  "Patient Folder", "Study Folder", "Series Folder", "Number of Slices", "Series Directory", "Body Part Label",
+                  "BODY PART (BP)", "BP Confidence", "IV CONTRAST (IVC)", "IVC Confidence", "Selected"]
+#CT Image Storage, the slice-wise loader does not support multi-frame (enhanced) objects
+ACCEPTED_SOP_CLASSES = ["1.2.840.10008.5.1.4.1.1.2"]
+#Tags read by get_dicom_info, parsing stops behind the last of them (Columns)
+LISTING_TAGS = ["ImageType", "SOPClassUID", "Modality", "StudyDescription", "SeriesDescription", "PatientID", 
+                "StudyInstanceUID", "SeriesInstanceUID", "Rows", "Columns"]
+
+LISTING_POLL_INTERVAL = 100 #ms, rate at which the GUI picks up the progress of a running listing
+
+class ListingCancelled(Exception):
+    pass
+
+def create_series_df(directory, settings, min_dcm_files, report_progress=None, cancel_event=None):
+    """Traverse the given directory and collect series information. Does not touch the GUI, so it can run in a 
+    background thread: the progress is passed to report_progress(fraction, eta) after every directory and the 
+    listing stops with ListingCancelled once cancel_event is set.
+    Returns (series table, rejected series table, number of directories visited)."""
     series_dict = {}  # Dictionary to hold series information
-    series_lookup = {}
-    directory = app.directory
-    app.progress_var.set("Initializing Series Listing...")
-    app.progress_label.update()
-    total_files = 0
-    j = 0
-    for _, _, files in os.walk(directory): total_files += len(files)
+    rejected_dict = {}  # Series excluded by the header filter, with the reason
+    #kept outside of the output folder, which is deleted by a reset (i.e. before most listings)
+    index_dir = settings.get("scan_index_dir", "") or get_default_index_dir(directory)
+    #number of directories of the previous listing of this directory, if any, for the progress estimate
+    previous_dirs = load_listing_stats(index_dir).get("directories", 0)
     start_time = time.time()
-    by_ending=app.settings["dcm_ending"]
-
-    for root, dirs, files in os.walk(directory):
-        i = 0
-        j += len(files)
-        for file in files:
-            filepath = os.path.join(root, file)
-            i += 1
-            # Check if the file is a DICOM file
-            if not is_dicom_file(filepath, by_ending=by_ending):
-                if i==3: break #allow up to 2 non-dcm files in a folder before considering it not a dcm series folder
-                continue
-            else:
-                dicom_info = get_dicom_info(filepath)
-                if dicom_info is None:
-                    if i==3: break #similarly, allow up to 2 dicom files without series info 
-                    continue
+    by_ending=settings["dcm_ending"]
+    header_filter = settings.get("header_filter", True)
+    accepted_modalities = settings.get("accepted_modalities", ["CT"])
+    group_series = settings.get("group_series_by_uid", False)
+    columns = SERIES_COLUMNS + (["Series Files"] if group_series else [])
+
+    #with several workers, directories are scanned by a thread pool as soon as they are discovered, while the results
+    #are still consumed here in the same top-down order as os.walk, so the listing is identical to the sequential one
+    scan_workers = settings.get("scan_workers", 8)
+    executor = ThreadPoolExecutor(max_workers=scan_workers) if scan_workers > 1 else None
+    #unchanged directories of earlier (or interrupted) listings are taken from the scan index instead of being scanned
+    index = None
+    if settings.get("scan_index", True):
+        try: index = ScanIndex(index_dir, mode=f"by_ending={by_ending},group_series={group_series}")
+        except Exception as e: print(f"Scan index in {index_dir} not available ({e}), scanning all directories.")
+    header_bytes = [] #bytes read per sampled DICOM header, only of directories actually scanned (not taken from the index)
+    def scan_counted(path):
+        result = scan_directory(path, by_ending=by_ending, group_series=group_series)
+        header_bytes.extend(dicom_info["Header Bytes"] for dicom_info, _, _ in result[1])
+        return result
+    def run_scan(path):
+        if index is None: return scan_counted(path)[:2], None
+        return scan_directory_indexed(path, scan_counted, index)
+    def start_scan(path):
+        return executor.submit(run_scan, path) if executor is not None else None
+
+    to_visit = [(directory, start_scan(directory))]
+    visited = 0
+    try:
+        while to_visit:
+            if cancel_event is not None and cancel_event.is_set(): raise ListingCancelled()
+            root, scan = to_visit.pop()
+            (subdirs, series_found), mtime_ns = scan.result() if scan is not None else run_scan(root)
+            if mtime_ns is not None: index.add(root, mtime_ns, (subdirs, series_found))
+            to_visit.extend(reversed([(subdir, start_scan(subdir)) for subdir in subdirs]))
+            visited += 1
+            for dicom_info, num_slices, files in series_found:
                 #a dicom file with series info has been found
                 series_uid = dicom_info["Series Instance UID"]
-                if series_uid not in series_dict:
-                    # If the series is new, add it to the dict
-                    series_dict[series_uid] = {
-                        "Index": -1,
-                        "Patient ID": dicom_info["Patient ID"],
-                        "Study Instance UID": dicom_info["Study Instance UID"],
-                        "Series Instance UID": series_uid,
-                        "Study Description" : dicom_info["Study Description"],
-                        "Series Description": dicom_info["Series Description"],
-                        "Patient Folder": dicom_info["Patient Folder"],
-                        "Study Folder": dicom_info["Study Folder"],
-                        "Series Folder": dicom_info["Series Folder"],
-                        "Number of Slices": len(files) + 1 - i, #subtract the invalid files
-                        "Series Directory": root,
-                        "Body Part Label": " ",
-                        "BODY PART (BP)": " ",
-                        "BP Confidence": " ",
-                        "IV CONTRAST (IVC)": " ",
-                        "IVC Confidence": " ",
-                        "Selected": True
-                    }
-                break
+                if series_uid not in series_dict and series_uid not in rejected_dict:
+                    entry = get_series_entry(dicom_info, num_slices, root)
+                    if group_series: entry["Series Files"] = SERIES_FILES_SEPARATOR.join(files) if files else ""
+                    reason = get_rejection_reason(dicom_info, accepted_modalities) if header_filter else None
+                    if reason is None: series_dict[series_uid] = entry
+                    else: rejected_dict[series_uid] = dict(entry, **{"Rejection Reason": reason}) #no pixel data is read for these
                 
-        #dir processed
-        elapsed_time = time.time() - start_time
-        seconds = round((elapsed_time / (j + 1)) * (total_files - (j + 1)))
-        eta = timedelta(seconds=seconds)
-        app.progress_var.set(f"Series Listing Progress:     {((j + 1) / total_files * 100):.2f}%       ETA: {str(eta)}")
-        app.progress_label.update()
-
-    df = pd.DataFrame.from_dict(series_dict, orient="index")
-    filtered_df = df[df["Number of Slices"] >= min_dcm_files]
+            #dir processed
+            if previous_dirs: fraction = min(visited / previous_dirs, 0.9999)
+            else: fraction = visited / (visited + len(to_visit)) #directories found so far, grows towards the real total
+            elapsed_time = time.time() - start_time
+            eta = timedelta(seconds=round(elapsed_time / fraction * (1 - fraction)))
+            if report_progress is not None: report_progress(fraction, eta)
+    finally:
+        if executor is not None: executor.shutdown(wait=True, cancel_futures=True)
+        if index is not None: index.close() #also the final checkpoint, or the one of an interrupted listing
+    save_listing_stats(index_dir, visited)
+    if settings.get("verbose", False):
+        if header_bytes: print(f"Listing read {np.mean(header_bytes):.0f} bytes per sampled DICOM header ({len(header_bytes)} headers)")
+
+    df = pd.DataFrame.from_dict(series_dict, orient="index", columns=columns)
+    filtered_df = df[df["Number of Slices"] >= min_dcm_files].copy()
+    for series_uid, entry in df[df["Number of Slices"] < min_dcm_files].iterrows():
+        rejected_dict[series_uid] = dict(entry, **{"Rejection Reason": f"Less than {min_dcm_files} slices"})
+    rejected_df = pd.DataFrame.from_dict(rejected_dict, orient="index", columns=columns + ["Rejection Reason"])
     filtered_df["Index"] = range(1, len(filtered_df)+1)
     filtered_df["idx"] = range(1, len(filtered_df)+1)
     filtered_df.set_index("idx", inplace=True)
-    return filtered_df
+    return filtered_df, rejected_df, visited
+
+def scan_directory(path, by_ending=True, group_series=False):
+    """Single os.scandir pass over one directory. Returns its subdirectories and the series found in it as a list of
+    (dicom_info, num_slices, files). By default, the directory is treated as a single series: dicom_info is the header 
+    information of its first valid file, num_slices the number of files minus the invalid ones before it and files None.
+    At most 3 files are examined; all other entries are only counted, no list of file paths is built.
+    With group_series, the Series Instance UID of every file of a series directory is read, giving exact slice counts
+    and, if the directory does not hold exactly one series, the list of file names of each series.
+    Returns (subdirs, series, complete): complete is False if a read error occurred (e.g. a transient network or
+    permission error), the result then only holds what could be read and must not be stored in the scan index."""
+    subdirs, dicom_info, names = [], None, []
+    num_files, num_invalid, examining = 0, 0, True
+    errors = [] #read errors, the scan is incomplete if there are any
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try: is_dir = entry.is_dir()
+                except OSError as e: errors.append(e); is_dir = False
+                if is_dir:
+                    if not entry.is_symlink(): subdirs.append(entry.path) #like os.walk, symlinked directories are not followed
+                    continue
+                num_files += 1
+                if not examining:
+                    if group_series and dicom_info is not None: names.append(entry.name)
+                    continue
+                try: dicom_info = read_listing_info(entry.path, by_ending=by_ending)
+                except OSError as e: errors.append(e)
+                if dicom_info is not None:
+                    examining = False
+                    names.append(entry.name)
+                else:
+                    num_invalid += 1
+                    if num_files == 3: examining = False #allow up to 2 non-dcm files (or dicom files without series info) in a folder
+    except OSError as e:
+        errors.append(e) #unreadable directory, skipped like in os.walk
+    series = []
+    if dicom_info is not None and not group_series: series = [(dicom_info, num_files - num_invalid, None)]
+    elif dicom_info is not None: series = group_directory(path, names, dicom_info, num_files, by_ending=by_ending, errors=errors)
+    if errors: print(f"Could not read all of {path} ({errors[0]}), it is scanned again by the next listing.")
+    return subdirs, series, not errors
+
+def read_listing_info(filepath, by_ending=True):
+    """Header information of a file for the listing (see get_dicom_info), None if it is no DICOM file or has no
+    series information. Read errors (OSError) are raised, so they are not mistaken for a non-DICOM file."""
+    if by_ending and not filepath.endswith(".dcm"): return None
+    try: return get_dicom_info(filepath)
+    except OSError: raise
+    except Exception: return None
+
+def group_directory(path, names, first_info, num_files, by_ending=True, errors=None):
+    """Split the files of a series directory by Series Instance UID (only this tag is read per file).
+    first_info is the header information of the first file in names. Read errors are appended to errors."""
+    errors = [] if errors is None else errors
+    groups = {first_info["Series Instance UID"]: [names[0]]}
+    for name in names[1:]:
+        try: series_uid = sniff_series_uid(os.path.join(path, name), by_ending=by_ending)
+        except OSError as e: errors.append(e); continue
+        if series_uid is not None: groups.setdefault(series_uid, []).append(name)
+    series = []
+    for series_uid, files in groups.items():
+        try: dicom_info = first_info if series_uid == first_info["Series Instance UID"] else read_listing_info(os.path.join(path, files[0]), by_ending=False)
+        except OSError as e: errors.append(e); continue
+        if dicom_info is None: continue
+        #a directory that holds exactly one series is still loaded by listing the folder
+        series.append((dicom_info, len(files), files if len(files) != num_files else None))
+    return series
+
+def sniff_series_uid(filepath, by_ending=True):
+    """Series Instance UID of a file, or None if it is no DICOM file or has none. Parsing stops behind the tag."""
+    if by_ending and not filepath.endswith(".dcm"): return None
+    try: dicom_data, _ = read_tags(filepath, ["SeriesInstanceUID"], stop_after="SeriesInstanceUID")
+    except OSError: raise #a read error, not a file without series
+    except Exception: return None
+    series_uid = str(dicom_data.get("SeriesInstanceUID", "") or "")
+    return series_uid if series_uid else None
+
+LISTING_STATS_FILE = "listing_stats.json"
+
+def load_listing_stats(index_dir):
+    try:
+        with open(os.path.join(index_dir, LISTING_STATS_FILE), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_listing_stats(index_dir, num_directories):
+    """Store the number of directories of a complete listing next to the scan index of the listed directory."""
+    try:
+        os.makedirs(index_dir, exist_ok=True)
+        with open(os.path.join(index_dir, LISTING_STATS_FILE), "w") as f:
+            json.dump({"directories": num_directories}, f)
+    except OSError as e:
+        print(f"Could not save the listing statistics in {index_dir}: {e}")
+
+def get_series_entry(dicom_info, num_slices, series_dir):
+    """Row of the series table for a series, from the header information of one of its files."""
+    return {
+        "Index": -1,
+        "Patient ID": dicom_info["Patient ID"],
+        "Study Instance UID": dicom_info["Study Instance UID"],
+        "Series Instance UID": dicom_info["Series Instance UID"],
+        "Study Description" : dicom_info["Study Description"],
+        "Series Description": dicom_info["Series Description"],
+        "Patient Folder": dicom_info["Patient Folder"],
+        "Study Folder": dicom_info["Study Folder"],
+        "Series Folder": dicom_info["Series Folder"],
+        "Number of Slices": num_slices,
+        "Series Directory": series_dir,
+        "Body Part Label": " ",
+        "BODY PART (BP)": " ",
+        "BP Confidence": " ",
+        "IV CONTRAST (IVC)": " ",
+        "IVC Confidence": " ",
+        "Selected": True
+    }
+
+def get_rejection_reason(dicom_info, accepted_modalities=("CT",)):
+    """Reason why a series can not be processed, judged from the header of one of its files (None if it is accepted).
+    Tags that are missing in the header never lead to a rejection."""
+    if accepted_modalities and dicom_info["Modality"] not in ["unknown"] + list(accepted_modalities):
+        return f"Modality {dicom_info['Modality']}"
+    if "LOCALIZER" in dicom_info["Image Type"]: return "Localizer (scout) image"
+    if dicom_info["SOP Class UID"] not in ["unknown"] + ACCEPTED_SOP_CLASSES:
+        return f"SOP Class UID {dicom_info['SOP Class UID']} (no CT image)"
+    if not dicom_info["Has Pixel Data"]: return "No pixel data"
+    return None
 
 def get_dicom_info(filepath):
     """Extract key information from a DICOM file, handling missing attributes."""
-    dicom_data = pydicom.dcmread(filepath, stop_before_pixels=True)
+    dicom_data, header_bytes = read_tags(filepath, LISTING_TAGS, stop_after="Columns")
     data = {}
     
     # Check if it's a regular DICOM file and has necessary attributes
@@ -95,6 +254,20 @@ def get_dicom_info(filepath):
     try: data["Series Description"] = dicom_data.SeriesDescription
     except: data["Series Description"] = "unknown"
 
+    #tags for the header filter
+    try: data["Modality"] = str(dicom_data.Modality)
+    except: data["Modality"] = "unknown"
+
+    try: data["Image Type"] = [str(value).upper() for value in dicom_data.ImageType]
+    except: data["Image Type"] = []
+
+    try: data["SOP Class UID"] = str(dicom_data.SOPClassUID)
+    except: data["SOP Class UID"] = "unknown"
+
+    #the pixel data itself is not read, an image pixel description means that the file holds an image
+    data["Has Pixel Data"] = "Rows" in dicom_data and "Columns" in dicom_data
+    data["Header Bytes"] = header_bytes
+
     path_parts = filepath.split(os.sep)
     try: data["Series Folder"] = path_parts[-2]
     except: data["Series Folder"] = "unknown"
@@ -112,6 +285,7 @@ def get_dicom_info(filepath):
 
 def load_and_display_series(app):
     """List series in the selected directory."""
+    cancel_listing(app) #a listing that is still running for another directory is abandoned
     app.directory = app.directory_var.get()
     app.out_dir = os.path.join(app.directory, app.settings["output_folder"])
     min_dcm_files = app.settings["min_dcm"]
@@ -139,19 +313,76 @@ def load_and_display_series(app):
             predicted_indices = app.predicted_series.index
             app.series_data = app.series_data.drop(predicted_indices)
         app.update_tables()
+        enable_series_controls(app)
     else:
-        app.progress_var.set(f"Loading all DICOM series in directory...")
-        app.series_data = create_series_df(app, min_dcm_files,)
-        app.all_series_data = app.series_data.copy()
-        if len(app.series_data) == 0:
-            app.progress_var.set(f"No series found in directory. Please adjust settings or change directory.")
-            return
-        os.makedirs(app.out_dir, exist_ok=True)
-        app.series_data.to_csv(list_csv, index=True)
-        app.update_tables()
-        app.progress_var.set(f"DICOM series loaded. Press Play to start the prediction.")
-        app.provide_button.config(state="normal", cursor="hand2")
-        update_start_button(app, "Start")
+        start_listing(app, min_dcm_files)
+
+def start_listing(app, min_dcm_files):
+    """Run create_series_df in a background thread. Its progress and result reach the GUI through a queue that is 
+    polled from the Tk main loop every LISTING_POLL_INTERVAL ms."""
+    app.progress_var.set(f"Loading all DICOM series in directory...")
+    listing = {"queue": queue.Queue(), "cancel": threading.Event(), "last_report": 0.0}
+    app.listing = listing
+    directory, settings = app.directory, dict(app.settings)
+
+    def report_progress(fraction, eta):
+        if time.time() - listing["last_report"] < LISTING_POLL_INTERVAL / 1000: return #the GUI would not show it anyway
+        listing["last_report"] = time.time()
+        listing["queue"].put(("progress", f"Series Listing Progress:     {(fraction * 100):.2f}%       ETA: {str(eta)}"))
+
+    def run():
+        try: listing["queue"].put(("done", create_series_df(directory, settings, min_dcm_files, report_progress, listing["cancel"])))
+        except ListingCancelled: listing["queue"].put(("cancelled", None))
+        except Exception as e: listing["queue"].put(("error", e))
+
+    app.settings_button.config(state="disabled", cursor="arrow") #changed settings could reset the directory during the listing
+    app.cancel_listing_button.pack(side="left", padx=(20,0))
+    threading.Thread(target=run, daemon=True).start()
+    app.root.after(LISTING_POLL_INTERVAL, poll_listing, app, listing)
+
+def poll_listing(app, listing):
+    if getattr(app, "listing", None) is not listing: return #cancelled or replaced by a newer listing
+    message = None
+    while True:
+        try: kind, value = listing["queue"].get_nowait()
+        except queue.Empty: break
+        if kind == "progress": message = value
+        else: return finish_listing(app, kind, value)
+    if message is not None: app.progress_var.set(message)
+    app.root.after(LISTING_POLL_INTERVAL, poll_listing, app, listing)
+
+def cancel_listing(app): #Called by the Cancel button
+    listing = getattr(app, "listing", None)
+    if listing is None: return
+    listing["cancel"].set()
+    app.listing = None
+    app.cancel_listing_button.pack_forget()
+    app.settings_button.config(state="normal", cursor="hand2")
+    app.progress_var.set("Series listing cancelled. Already scanned directories are re-used by the next listing.")
+
+def finish_listing(app, kind, value):
+    app.listing = None
+    app.cancel_listing_button.pack_forget()
+    app.settings_button.config(state="normal", cursor="hand2")
+    if kind == "cancelled": return
+    if kind == "error":
+        app.progress_var.set(f"Series listing failed: {value}")
+        return
+    app.series_data, app.rejected_series, _ = value
+    app.all_series_data = app.series_data.copy()
+    if len(app.series_data) == 0:
+        app.progress_var.set(f"No series found in directory ({len(app.rejected_series)} rejected). Please adjust settings or change directory.")
+        return
+    os.makedirs(app.out_dir, exist_ok=True)
+    app.series_data.to_csv(os.path.join(app.out_dir,"list_of_series.csv"), index=True)
+    app.rejected_series.to_csv(os.path.join(app.out_dir, "rejected_series.csv"), index=False)
+    app.update_tables()
+    app.progress_var.set(f"DICOM series loaded ({len(app.rejected_series)} rejected, see rejected_series.csv). Press Play to start the prediction.")
+    app.provide_button.config(state="normal", cursor="hand2")
+    update_start_button(app, "Start")
+    enable_series_controls(app)
+
+def enable_series_controls(app):
     #app.reset_button.config(state="normal", cursor="hand2")
     update_reset_button(app, "Active")
-    app.edit_button.config(state="normal", cursor="hand2")  # Enable Edit button
\ No newline at end of file
+    app.edit_button.config(state="normal", cursor="hand2")  # Enable Edit button
@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+import sqlite3
+import numpy as np
+import threading
+
+def get_volume_key(series_uid, files, by_ending=True):
+    """Cache key of a decoded series: Series Instance UID plus a fingerprint of the names, sizes and mtimes of its files
+    and of how the DICOM files were selected among them (by_ending, see is_dicom_file)."""
+    fingerprint = hashlib.sha1(f"by_ending={bool(by_ending)}\n".encode())
+    for file in sorted(files):
+        stat = os.stat(file)
+        fingerprint.update(f"{os.path.basename(file)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    uid_part = "".join(c if c.isalnum() or c == "." else "_" for c in str(series_uid))
+    return f"{uid_part}_{fingerprint.hexdigest()[:16]}"
+
+def load_cached_volume(cache_dir, key):
+    """Return (volume, spacing, direction, origin) for a cached series, or None on a miss.
+    The volume is a read-only memmap, so no data is copied until it is actually accessed."""
+    volume_path = os.path.join(cache_dir, key + ".npy")
+    geometry_path = os.path.join(cache_dir, key + ".json")
+    if not (os.path.exists(volume_path) and os.path.exists(geometry_path)): return None
+    try:
+        with open(geometry_path, "r") as f:
+            geometry = json.load(f)
+        volume = np.load(volume_path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None #incomplete or corrupt entry, treat as miss
+    return volume, geometry["spacing"], geometry["direction"], geometry["origin"]
+
+def store_cached_volume(cache_dir, key, volume, spacing, direction, origin):
+    """Write a decoded HU volume and its geometry to the cache (atomically, so readers never see partial files)."""
+    os.makedirs(cache_dir, exist_ok=True)
+    volume_path = os.path.join(cache_dir, key + ".npy")
+    geometry_path = os.path.join(cache_dir, key + ".json")
+    volume_tmp, geometry_tmp = get_tmp_path(volume_path), get_tmp_path(geometry_path)
+    with open(volume_tmp, "wb") as f:
+        np.save(f, np.ascontiguousarray(volume))
+    with open(geometry_tmp, "w") as f:
+        json.dump({"spacing": [float(s) for s in spacing], "direction": [float(d) for d in direction],
+                   "origin": [float(o) for o in origin]}, f)
+    os.replace(volume_tmp, volume_path)
+    os.replace(geometry_tmp, geometry_path) #json last: an entry only counts as complete once it exists
+
+def get_tmp_path(path):
+    """Temporary file name next to path that is unique per process and thread, for atomic writes via os.replace."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{os.getpid()}_{threading.get_ident()}.tmp{ext}"
+
+MANIFEST_FILE = "manifest.sqlite"
+
+def get_preprocessed_key(series_uid, files, params):
+    """Cache key of a preprocessed series: the decoded-volume key plus a hash of the preprocessing parameters."""
+    params_hash = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+    return f"{get_volume_key(series_uid, files)}_{params_hash}"
+
+def open_manifest(cache_dir):
+    """Open (and create if needed) the manifest of a cache folder: hit/miss counters and one entry per stored key.
+    SQLite serialises the writers, so workers in several threads or processes can record accesses concurrently."""
+    os.makedirs(cache_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, MANIFEST_FILE), timeout=60)
+    conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, series_uid TEXT, location TEXT)")
+    return conn
+
+def record_cache_access(cache_dir, key, hit, series_uid=None, location=None):
+    """Count a hit or miss (and add the entry of a newly stored key) in the manifest of a cache folder.
+    Each access is a single small transaction, independent of the number of entries already recorded."""
+    conn = open_manifest(cache_dir)
+    try:
+        with conn:
+            counter = "hits" if hit else "misses"
+            conn.execute("INSERT OR IGNORE INTO counters VALUES (?, 0)", (counter,))
+            conn.execute("UPDATE counters SET value=value+1 WHERE name=?", (counter,))
+            if not hit and series_uid is not None:
+                conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, str(series_uid), location or key + ".nrrd"))
+    finally: conn.close()
+
+def read_manifest(cache_dir):
+    """Return the manifest of a cache folder as {"hits": ..., "misses": ..., "entries": {key: {...}}}."""
+    manifest = {"hits": 0, "misses": 0, "entries": {}}
+    if not os.path.exists(os.path.join(cache_dir, MANIFEST_FILE)): return manifest
+    conn = open_manifest(cache_dir)
+    try:
+        manifest.update(dict(conn.execute("SELECT name, value FROM counters").fetchall()))
+        for key, series_uid, location in conn.execute("SELECT key, series_uid, location FROM entries"):
+            manifest["entries"][key] = {"Series Instance UID": series_uid, "Location": location}
+    finally: conn.close()
+    return manifest
@@ -0,0 +1,72 @@
+import os
+import json
+import zlib
+import sqlite3
+import numpy as np
+import SimpleITK as sitk
+
+STORE_FILE = "preprocessed_store.sqlite"
+COMPRESSION_LEVEL = 1 #fast zlib level, the volumes are small and read far more often than written
+
+def open_volume_store(store_dir):
+    """Open (and create if needed) the consolidated store that holds all preprocessed volumes of a run,
+    chunked per slice so single slices or slabs can be read without decompressing the rest."""
+    os.makedirs(store_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(store_dir, STORE_FILE), timeout=60)
+    conn.execute("""CREATE TABLE IF NOT EXISTS volumes (key TEXT PRIMARY KEY, series_uid TEXT, depth INTEGER, rows INTEGER,
+                    cols INTEGER, dtype TEXT, spacing TEXT, origin TEXT)""")
+    conn.execute("CREATE TABLE IF NOT EXISTS slices (key TEXT, z INTEGER, data BLOB, PRIMARY KEY (key, z))")
+    return conn
+
+def has_volume(store_dir, key):
+    if not os.path.exists(os.path.join(store_dir, STORE_FILE)): return False
+    conn = open_volume_store(store_dir)
+    try: return conn.execute("SELECT 1 FROM volumes WHERE key=?", (key,)).fetchone() is not None
+    finally: conn.close()
+
+def write_volume(store_dir, key, sitk_image, series_uid=None):
+    """Write a preprocessed sitk image into the store, one compressed chunk per slice."""
+    arr = sitk.GetArrayViewFromImage(sitk_image)
+    conn = open_volume_store(store_dir)
+    try:
+        with conn: #single transaction, the volumes row is only visible together with all of its slices
+            conn.executemany("INSERT OR REPLACE INTO slices VALUES (?, ?, ?)",
+                             ((key, z, zlib.compress(np.ascontiguousarray(arr[z]).tobytes(), COMPRESSION_LEVEL)) for z in range(arr.shape[0])))
+            conn.execute("INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (key, str(series_uid), arr.shape[0], arr.shape[1], arr.shape[2], arr.dtype.str,
+                          json.dumps(list(sitk_image.GetSpacing())), json.dumps(list(sitk_image.GetOrigin()))))
+    finally: conn.close()
+
+class StoredVolume:
+    """Lazy handle on a preprocessed volume in the store. Nothing is read until slices are requested."""
+    def __init__(self, store_dir, key):
+        self.store_dir = store_dir
+        self.key = key
+        conn = open_volume_store(store_dir)
+        try: row = conn.execute("SELECT depth, rows, cols, dtype, spacing, origin FROM volumes WHERE key=?", (key,)).fetchone()
+        finally: conn.close()
+        if row is None: raise Exception(f"Volume {key} not found in the preprocessed store.")
+        depth, rows, cols, dtype, spacing, origin = row
+        self.shape = (depth, rows, cols)
+        self.dtype = np.dtype(dtype)
+        self.spacing = json.loads(spacing)
+        self.origin = json.loads(origin)
+
+    def read_slices(self, slice_range):
+        """Return the slices in slice_range (a range with step 1) as array, decompressing only those chunks."""
+        arr = np.empty((len(slice_range), self.shape[1], self.shape[2]), dtype=self.dtype)
+        conn = open_volume_store(self.store_dir)
+        try:
+            rows = conn.execute("SELECT z, data FROM slices WHERE key=? AND z>=? AND z<? ORDER BY z",
+                                (self.key, slice_range.start, slice_range.stop)).fetchall()
+        finally: conn.close()
+        if len(rows) != len(slice_range): raise Exception(f"Volume {self.key} is incomplete in the preprocessed store.")
+        for z, data in rows:
+            arr[z - slice_range.start] = np.frombuffer(zlib.decompress(data), dtype=self.dtype).reshape(self.shape[1], self.shape[2])
+        return arr
+
+    def to_sitk(self):
+        img = sitk.GetImageFromArray(self.read_slices(range(self.shape[0])))
+        img.SetSpacing(self.spacing)
+        img.SetOrigin(self.origin)
+        return img
@@ -5,10 +5,12 @@ import gc
 import os
 import pandas as pd
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 from src.preprocessing.preprocess_series import preprocess_series
-from src.prediction.get_probabilities import get_body_part_probabilities, get_contrast_probability
-from src.prediction.prediction_utils import load_models
-from src.user_interface.ui_utils import update_start_button, update_reset_button
+from src.preprocessing.parallel_preprocessing import ProcessPoolPrefetcher
+from src.prediction.get_probabilities import get_volume_view, get_body_part_input, get_contrast_input, get_body_part_probabilities_batch, get_contrast_probabilities_batch
+from src.prediction.prediction_utils import ModelRegistry
+from src.user_interface.ui_utils import update_start_button, update_reset_button, wait_for_future
 from src.user_interface.finished_popup import show_finished_popup
 
 #series_info: [index, patient_name, study, series, len(dcm_files), root, mrn, series_uid, (body_part)]
@@ -16,45 +18,73 @@ from src.user_interface.finished_popup import show_finished_popup
 LABEL_DICT = {0:'HeadNeck', 1:'Chest', 2:'Abdomen'}
 REV_LABEL_DICT = {'HeadNeck':0, 'Chest':1, 'Abdomen':2}
 
+def get_preprocessing_options(settings, out_dir):
+    """Collect the keyword arguments of preprocess_series from the settings."""
+    return {
+        "save_nrrds": settings.get("store_nrrd_files", False),
+        "dicoms_by_ending": settings.get("dcm_ending", True),
+        "decode_workers": settings.get("decode_workers", 4),
+        "slab_mode": settings.get("slab_preprocessing", True),
+        "volume_cache_dir": settings.get("volume_cache_dir", "") or None,
+        "preprocessed_dir": settings.get("preprocessed_cache_dir", "") or os.path.join(out_dir, "preprocessed"),
+        "storage": settings.get("preprocessed_storage", "nrrd"),
+        "fused": settings.get("fused_preprocessing", False),
+        "reduced_precision": settings.get("reduced_precision", False),
+        "memory_budget": settings.get("memory_budget_mb", 0) * 2**20,
+    }
+
 def process_loop(app):
+    """Predict the selected series until all are done or the user pauses. The GUI is updated while waiting for
+    preprocessing and models, so pausing and resuming during such a wait continues this loop (see start_prediction)
+    instead of starting a second one."""
+    app.loop_running = True
+    try:
+        run_process_loop(app)
+        while app.prediction_in_progress and not app.is_paused: run_process_loop(app) #resumed while the loop stopped for a pause
+    finally: app.loop_running = False
+
+def run_process_loop(app):
     verbose = app.settings.get("verbose",False)
-    store_preprocessed = app.settings.get("store_nrrd_files", False)
-    dicoms_by_ending = app.settings.get("dcm_ending", True)
     human_readable = app.settings.get("human_readable_output", True)
+    prefetch_depth = app.settings.get("prefetch_depth", 2)
+    preprocessing_processes = app.settings.get("preprocessing_processes", 0)
+    batch_size = max(1, app.settings.get("inference_batch_size", 1)) #batching is opt-in until verified on the released models
+    max_wait = app.settings.get("inference_max_wait", 5.0) #seconds a prepared series may wait for its batch to fill
+    options = get_preprocessing_options(app.settings, app.out_dir)
     if verbose: print("Starting the processing of series...")
     start_time = time.time()
     #to_do = [s for s in app.series_data if s[-1]]  # Only process selected series
     to_do = app.series_data[app.series_data["Selected"]==True].copy()
-    num_pred = len(to_do)
     models = None
-    if len(to_do):
-        app.progress_var.set(f"Initializing Prediction...")
-        models = load_models(app.device)
-        if store_preprocessed:
-            preprocessed_dir = os.path.join(app.out_dir, "preprocessed")
-            if not os.path.exists(preprocessed_dir): os.makedirs(preprocessed_dir)
-        if len(app.predicted_series) == 0: app.predicted_series = pd.DataFrame(columns=app.series_data.columns)
-
-    for i, (index,series) in enumerate(to_do.iterrows()):
-        gc.collect()
-        app.root.update()
-        if app.is_paused:
-            del models
-            gc.collect()
-            return
-        series["BODY PART (BP)"], series["BP Confidence"], series["IV CONTRAST (IVC)"], series["IVC Confidence"] = process(models, 
-                                    series, app.out_dir, device=app.device, save_nrrds=store_preprocessed, verbose=verbose, dicoms_by_ending=dicoms_by_ending, human_readable=human_readable)
-        elapsed_time = time.time() - start_time
-        seconds = round((elapsed_time / (i + 1)) * (num_pred - (i + 1)))
-        eta = timedelta(seconds=seconds)
-        app.progress_var.set(f"Prediction Progress:    {((i + 1) / num_pred * 100):.2f}%       ETA: {str(eta)}")
-        app.series_data = app.series_data[app.series_data["Index"]!=series["Index"]]
-        newly_predicted = pd.DataFrame([series], columns=app.predicted_series.columns)
-        if app.predicted_series.empty: app.predicted_series = newly_predicted.copy()
-        else: app.predicted_series = pd.concat([app.predicted_series, newly_predicted], ignore_index=False)
-        app.update_tables()
-        app.predicted_series.sort_values(by='Index', ascending=True, inplace=False).to_csv(os.path.join(app.out_dir, "predictions.csv"), index=True, index_label='idx')
-    del models
+    prefetcher = None
+    try:
+        if len(to_do):
+            app.progress_var.set(f"Initializing Prediction...")
+            models = get_model_registry(app) #loaded in the background since the application start and kept across pauses
+            models.verbose = verbose
+            if options["save_nrrds"]:
+                if not os.path.exists(options["preprocessed_dir"]): os.makedirs(options["preprocessed_dir"])
+            if len(app.predicted_series) == 0: app.predicted_series = pd.DataFrame(columns=app.series_data.columns)
+            #background workers preprocess the next series while the current one runs through the models
+            if preprocessing_processes > 0: prefetcher = ProcessPoolPrefetcher(to_do, preprocessing_processes, prefetch_depth, app.out_dir, 
+                                                                               verbose=verbose, options=options)
+            elif prefetch_depth > 0: prefetcher = SeriesPrefetcher(to_do, prefetch_depth, app.out_dir, verbose=verbose, options=options)
+        completed = predict_to_do(app, to_do, models, prefetcher, options, batch_size, max_wait, start_time, verbose=verbose, 
+                                  human_readable=human_readable)
+    except Exception as e:
+        print(e)
+        app.progress_var.set(str(e))
+        update_start_button(app, "Start")
+        app.prediction_in_progress = False
+        update_reset_button(app, "Active")
+        return
+    finally:
+        if prefetcher is not None: prefetcher.stop() #also frees the worker processes and shared memory after an error
+    gc.collect()
+    if not completed: #paused
+        update_reset_button(app, "Active") #only allowed once the loop has stopped
+        return
+    if verbose and models is not None: print(f"Model load times: {', '.join(f'{name} {t:.2f}s' for name, t in models.load_times.items())}")
     #app.start_button.config(text="Start Prediction")
     update_start_button(app, "Start")
     app.prediction_in_progress = False
@@ -62,43 +92,154 @@ def process_loop(app):
     update_reset_button(app, "Active")
     show_finished_popup(app)
 
-def process(models, series_info, out_directory=None, device='cpu', save_nrrds=False, verbose=False, dicoms_by_ending=True, human_readable=True):
+def predict_to_do(app, to_do, models, prefetcher, options, batch_size, max_wait, start_time, verbose=False, human_readable=True):
+    """Preprocess and predict the series of to_do in batches. Returns False if the user paused, True once all are done."""
+    num_pred = len(to_do)
+    batch = [] #prepared series waiting for the batched prediction
+    batch_start = None
+    num_done = 0
+    for i, (index,series) in enumerate(to_do.iterrows()):
+        gc.collect()
+        app.root.update()
+        if batch and (app.is_paused or time.time() - batch_start >= max_wait):
+            num_done = finish_batch(app, models, batch, num_done, num_pred, start_time, verbose=verbose, human_readable=human_readable)
+            batch = []
+        if app.is_paused: return False
+        if prefetcher is not None:
+            img = prefetcher.get(i, wait_callback=app.root.update)
+            if verbose: print(f"\nPreparing series {series['Index']} (preprocessed in the background):")
+        else:
+            if verbose: print(f"\nProcessing series {series['Index']}:")
+            img = preprocess_series(series_info=series, out_directory=app.out_dir, verbose=verbose, **options)
+        if not batch: batch_start = time.time()
+        batch.append((series, prepare_series_inputs(series, img)))
+        if hasattr(img, "release"): img.release() #volumes handed over in shared memory are freed right away
+        del img
+        if len(batch) >= batch_size or i == num_pred - 1 or time.time() - batch_start >= max_wait:
+            num_done = finish_batch(app, models, batch, num_done, num_pred, start_time, verbose=verbose, human_readable=human_readable)
+            batch = []
+    return True
+
+def get_model_registry(app):
+    """The model registry of the app, (re)created if there is none yet or the backend or precision changed in the settings.
+    Raises an exception if the selected backend cannot run."""
+    backend, precision = app.get_inference_backend(), app.settings.get("inference_precision", "float32")
+    if app.models is None or (app.models.backend, app.models.precision) != (backend, precision):
+        app.models = ModelRegistry(app.device, verbose=app.settings.get("verbose", False), backend=backend, precision=precision)
+    return app.models
+
+def process(models, series_info, out_directory=None, device='cpu', verbose=False, human_readable=True, **preprocess_options):
     if verbose: print(f"\nProcessing series {series_info['Index']}:")
-    img = preprocess_series(series_info=series_info, out_directory=out_directory, verbose=verbose, save_nrrds=save_nrrds, dicoms_by_ending=dicoms_by_ending)
-    if img is None: return 'ERROR', 'ERROR', 'ERROR', 'ERROR'
-    if models is None: return 'NOMODEL', 'NOMODEL', 'NOMODEL', 'NOMODEL'
-    part_model, hn_model, ch_model, ab_model = models
-    
+    img = preprocess_series(series_info=series_info, out_directory=out_directory, verbose=verbose, **preprocess_options)
+    return predict_series(models, series_info, img, device=device, verbose=verbose, human_readable=human_readable)
+
+def predict_series(models, series_info, img, device='cpu', verbose=False, human_readable=True):
+    return predict_batch(models, [(series_info, prepare_series_inputs(series_info, img))], device=device, verbose=verbose, 
+                         human_readable=human_readable)[0]
+
+def prepare_series_inputs(series_info, img):
+    """Model inputs of one series: the body-part input (None if a body-part label was provided) and the contrast input 
+    of every part that can be predicted for it. Once these are built, the preprocessed volume is no longer needed."""
+    if img is None: return None
+    view = get_volume_view(img) #read once, shared by the inputs of all models
     if series_info["Body Part Label"] in ["HeadNeck", "Chest", "Abdomen"]:
-        if verbose: print(f"Using provided body-part label {series_info['Body Part Label']}.")
-        part_prediction = REV_LABEL_DICT[series_info["Body Part Label"]]
-        part_conf = "Provided"
-    else:
-        if verbose: print("Predicting the body-part for this series:")
-        part_probabilities = get_body_part_probabilities(part_model, img, device=device)
-        if verbose: print(f"Got the following probabilities for the body-parts: {part_probabilities}")
-        part_prediction = np.argmax(part_probabilities)
-        part_conf = str(round(part_probabilities[part_prediction]*100,2))+"%" if human_readable else round(part_probabilities[part_prediction],4)
-        if verbose: print(f"Body-Part Prediction: {LABEL_DICT[part_prediction]} with confidence {part_conf}")
-
-    if verbose: print(f"Initiating contrast prediction with the {LABEL_DICT[part_prediction]}-Model...")
-    if part_prediction == 0: contrast_prob = get_contrast_probability(hn_model, img, part='HeadNeck', device=device)
-    elif part_prediction == 1: contrast_prob = get_contrast_probability(ch_model, img, part='Chest' ,device=device)
-    elif part_prediction == 2: contrast_prob = get_contrast_probability(ab_model, img, part='Abdomen', device=device)
-    else: raise Exception("FATAL ERROR, UNKNOWN PART PREDICTION.")
+        return {"part": None, "contrast": {series_info["Body Part Label"]: get_contrast_input(view, series_info["Body Part Label"])}}
+    return {"part": get_body_part_input(view), "contrast": {part: get_contrast_input(view, part) for part in REV_LABEL_DICT}}
+
+def predict_batch(models, batch, device='cpu', verbose=False, human_readable=True, wait_callback=None):
+    """Predict a list of (series_info, inputs from prepare_series_inputs). The body-part model runs once over all series 
+    without a provided label, then each contrast model once over the series of its part. Every series is computed 
+    exactly as on its own, results are returned in batch order.
+    models is a ModelRegistry, a model is only loaded when a series of the batch needs it."""
+    results = [None] * len(batch)
+    valid = []
+    for j, (series_info, inputs) in enumerate(batch):
+        if inputs is None: results[j] = 'ERROR', 'ERROR', 'ERROR', 'ERROR'
+        elif models is None: results[j] = 'NOMODEL', 'NOMODEL', 'NOMODEL', 'NOMODEL'
+        else: valid.append(j)
+    if not valid: return results
+
+    part_predictions, part_confs = {}, {}
+    for j in valid:
+        if batch[j][1]["part"] is None:
+            if verbose: print(f"Series {batch[j][0]['Index']}: Using provided body-part label {batch[j][0]['Body Part Label']}.")
+            part_predictions[j] = REV_LABEL_DICT[batch[j][0]["Body Part Label"]]
+            part_confs[j] = "Provided"
+    to_predict = [j for j in valid if j not in part_predictions]
+    if to_predict:
+        if verbose: print(f"Predicting the body-part for {len(to_predict)} series:")
+        all_probabilities = get_body_part_probabilities_batch(models.get("part", wait_callback=wait_callback), [batch[j][1]["part"] for j in to_predict], device=device)
+        for j, part_probabilities in zip(to_predict, all_probabilities):
+            if verbose: print(f"Series {batch[j][0]['Index']}: Got the following probabilities for the body-parts: {part_probabilities}")
+            part_prediction = np.argmax(part_probabilities)
+            part_predictions[j] = part_prediction
+            part_confs[j] = str(round(part_probabilities[part_prediction]*100,2))+"%" if human_readable else round(part_probabilities[part_prediction],4)
+            if verbose: print(f"Series {batch[j][0]['Index']}: Body-Part Prediction: {LABEL_DICT[part_prediction]} with confidence {part_confs[j]}")
 
     contrast_dict = {0:"No", 1:"Yes"}
-    contrast = int((contrast_prob >= 0.5))
-    if contrast == 0: contrast_prob = 1-contrast_prob
-    if human_readable: contrast = contrast_dict[contrast]
-    c_conf = str(round(contrast_prob*100,2))+"%" if human_readable else round(contrast_prob,4)
-    if verbose: print(f"Contrast Prediction: {contrast} with confidence {c_conf}")
-    del img
-    gc.collect()
-    return LABEL_DICT[part_prediction], part_conf, contrast, c_conf
+    for part, part_name in LABEL_DICT.items():
+        group = [j for j in valid if part_predictions[j] == part]
+        if not group: continue
+        if verbose: print(f"Initiating contrast prediction with the {part_name}-Model for {len(group)} series...")
+        contrast_probs = get_contrast_probabilities_batch(models.get(part_name, wait_callback=wait_callback), [batch[j][1]["contrast"][part_name] for j in group], device=device)
+        for j, contrast_prob in zip(group, contrast_probs):
+            contrast_prob = contrast_prob.item()
+            contrast = int((contrast_prob >= 0.5))
+            if contrast == 0: contrast_prob = 1-contrast_prob
+            if human_readable: contrast = contrast_dict[contrast]
+            c_conf = str(round(contrast_prob*100,2))+"%" if human_readable else round(contrast_prob,4)
+            if verbose: print(f"Series {batch[j][0]['Index']}: Contrast Prediction: {contrast} with confidence {c_conf}")
+            results[j] = LABEL_DICT[part_predictions[j]], part_confs[j], contrast, c_conf
+    return results
 
+def finish_batch(app, models, batch, num_done, num_pred, start_time, verbose=False, human_readable=True):
+    """Predict a batch of prepared series and move them to the predicted table and the predictions CSV.
+    Returns the number of series finished so far."""
+    results = predict_batch(models, batch, device=app.device, verbose=verbose, human_readable=human_readable, 
+                            wait_callback=app.root.update)
+    for (series, _), result in zip(batch, results):
+        series["BODY PART (BP)"], series["BP Confidence"], series["IV CONTRAST (IVC)"], series["IVC Confidence"] = result
+        num_done += 1
+        elapsed_time = time.time() - start_time
+        seconds = round((elapsed_time / num_done) * (num_pred - num_done))
+        eta = timedelta(seconds=seconds)
+        app.progress_var.set(f"Prediction Progress:    {(num_done / num_pred * 100):.2f}%       ETA: {str(eta)}")
+        app.series_data = app.series_data[app.series_data["Index"]!=series["Index"]]
+        newly_predicted = pd.DataFrame([series], columns=app.predicted_series.columns)
+        if app.predicted_series.empty: app.predicted_series = newly_predicted.copy()
+        else: app.predicted_series = pd.concat([app.predicted_series, newly_predicted], ignore_index=False)
+    app.update_tables()
+    app.predicted_series.sort_values(by='Index', ascending=True, inplace=False).to_csv(os.path.join(app.out_dir, "predictions.csv"), index=True, index_label='idx')
+    return num_done
 
+class SeriesPrefetcher:
+    """Preprocesses the series of a to-do list in background threads, keeping at most depth series ahead of the 
+    one currently requested. Results are handed out strictly in list order."""
+    def __init__(self, to_do, depth, out_directory, verbose=False, options=None):
+        self.series = [series for _, series in to_do.iterrows()]
+        self.depth = depth
+        self.out_directory = out_directory
+        self.verbose = verbose
+        self.options = options or {}
+        self.executor = ThreadPoolExecutor(max_workers=depth)
+        self.pending = {}
 
+    def submit_until(self, position):
+        for j in range(position, min(position + self.depth + 1, len(self.series))):
+            if j not in self.pending:
+                self.pending[j] = self.executor.submit(preprocess_series, series_info=self.series[j], out_directory=self.out_directory,
+                                                       verbose=self.verbose, **self.options)
 
+    def get(self, position, wait_callback=None):
+        """Return the preprocessed image of the series at position (None if preprocessing failed)."""
+        self.submit_until(position)
+        img = wait_for_future(self.pending.pop(position), wait_callback) #keep the GUI responsive while waiting
+        self.submit_until(position + 1) #the next series start while this one is predicted
+        return img
 
+    def stop(self):
+        """Drop all prefetched results, series that are already being preprocessed finish in the background."""
+        for future in self.pending.values(): future.cancel()
+        self.pending = {}
+        self.executor.shutdown(wait=False)
 
@@ -78,6 +78,9 @@ def build_gui(app, version="v1.0.0"):
     app.progress_label = Label(progress_frame, textvariable=app.progress_var)
     app.progress_label.pack(side="left", padx=(10,0))
 
+    #Cancel button, only shown while series are listed
+    app.cancel_listing_button = Button(progress_frame, text="Cancel", command=app.cancel_listing, cursor="hand2")
+
     separator2 = ttk.Separator(root, orient="horizontal")
     separator2.grid(row=5, column=0, columnspan=3, sticky="ew", pady=(0,20), padx=(20,20))
 
@@ -3,6 +3,8 @@ import pandas as pd
 from src.user_interface.ui_utils import get_font_size
 
 LABEL_DICT = {0:'HeadNeck', 1:'Chest', 2:'Abdomen'}
+VALID_LABELS = ["Chest", "HeadNeck", "Abdomen"]
+LABEL_CSV_CHUNK_SIZE = 100000 #rows of the label CSV parsed at once
 
 def show_provide_popup(app):
     """Displays the Provide Body-Part Labels pop-up window for selecting series to process."""
@@ -99,8 +101,11 @@ def show_provide_popup(app):
 
     def load_labels(csv_path, app, result_label):
         """Loads body-part labels from the CSV and updates all_series_data."""
-        num_found = get_bp_labels_from_csv(csv_path, app)
         total_series = len(app.all_series_data)
+        def show_progress(rows_read, num_found):
+            result_label.config(text=f"Reading CSV: {rows_read:,} rows read, labels for {num_found} of {total_series} series found so far...")
+            result_label.update()
+        num_found = get_bp_labels_from_csv(csv_path, app, progress_callback=show_progress)
         
         # Update the result label with the count of found labels
         result_label.config(text=f"For {num_found} of {total_series} series, labels have been found in the CSV.")
@@ -120,32 +125,35 @@ def save_changes(selection, app, popup):
     popup.destroy()
 
 
-def get_bp_labels_from_csv(csv_path, app):
-    """Updates all_series_data DataFrame with labels from the provided CSV based on Series UID."""
+def get_bp_labels_from_csv(csv_path, app, progress_callback=None):
+    """Updates all_series_data DataFrame with labels from the provided CSV based on Series UID.
+    The CSV is streamed in chunks of LABEL_CSV_CHUNK_SIZE rows, only the two needed columns are parsed and only rows of
+    listed series are kept, so the memory use does not grow with the size of the CSV. 
+    progress_callback(rows_read, num_found) is called after every chunk."""
     try:
-        label_df = pd.read_csv(csv_path)
-
         # Check if the CSV contains the necessary columns
-        if 'Series Instance UID' not in label_df.columns or 'Body Part Label' not in label_df.columns:
+        csv_columns = pd.read_csv(csv_path, nrows=0).columns
+        if 'Series Instance UID' not in csv_columns or 'Body Part Label' not in csv_columns:
             print("CSV does not contain all required columns (Series Instance UID and Body Part Label).")
             return 0
 
-        # Filter out rows that don't have the required body part labels
-        label_df = label_df[label_df['Body Part Label'].isin(["Chest", "HeadNeck", "Abdomen"])]
-
-        # Check for duplicates in Series Instance UID in label_df
-        if label_df.duplicated(subset=['Series Instance UID']).any():
+        listed_uids = set(app.all_series_data['Series Instance UID'].astype(str))
+        labels = {} #Series Instance UID -> label, the first valid row of a series wins
+        rows_read = 0
+        duplicates_found = False
+        for chunk in pd.read_csv(csv_path, usecols=['Series Instance UID', 'Body Part Label'], dtype=str, chunksize=LABEL_CSV_CHUNK_SIZE):
+            rows_read += len(chunk)
+            # Filter out rows that don't have the required body part labels or belong to series that are not listed
+            chunk = chunk[chunk['Body Part Label'].isin(VALID_LABELS) & chunk['Series Instance UID'].isin(listed_uids)]
+            for series_uid, label in zip(chunk['Series Instance UID'], chunk['Body Part Label']):
+                if series_uid in labels: duplicates_found = True
+                else: labels[series_uid] = label
+            if progress_callback is not None: progress_callback(rows_read, len(labels))
+
+        if duplicates_found:
             print("Warning: Duplicate Series Instance UID found in label_df. Removing duplicates.")
-            label_df = label_df.drop_duplicates(subset=['Series Instance UID'])
-
-        app.all_series_data['Body Part Label'] = ""
-        original_index = app.all_series_data.index #save index to avoid index confusion after matching
-
-        matched_df = pd.merge(app.all_series_data, label_df[['Series Instance UID', 'Body Part Label']], 
-                              on='Series Instance UID', how='left', suffixes=('', '_label_df'))
 
-        matched_df.index = original_index #Restore original index
-        app.all_series_data['Body Part Label'] = matched_df['Body Part Label_label_df'].fillna(" ")
+        app.all_series_data['Body Part Label'] = app.all_series_data['Series Instance UID'].astype(str).map(labels).fillna(" ")
         unique_matches_count = (app.all_series_data['Body Part Label'] != " ").sum()
 
     except Exception as e:
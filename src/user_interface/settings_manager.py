@@ -17,6 +17,26 @@ class SettingsManager:
             "dcm_ending": True,
             "output_folder": "out",
             "human_readable_output": True, 
+            "decode_workers": 4,
+            "slab_preprocessing": True,
+            "volume_cache_dir": "",
+            "preprocessed_cache_dir": "",
+            "preprocessed_storage": "nrrd",
+            "fused_preprocessing": False,
+            "reduced_precision": False,
+            "memory_budget_mb": 0,
+            "prefetch_depth": 2,
+            "preprocessing_processes": 0,
+            "header_filter": True,
+            "scan_workers": 8,
+            "scan_index": True,
+            "scan_index_dir": "",
+            "group_series_by_uid": False,
+            "inference_batch_size": 1,
+            "inference_max_wait": 5.0,
+            "inference_backend": "torch",
+            "inference_precision": "float32",
+            "accepted_modalities": ["CT"],
             "series_table_columns": {
                 'Index': True,
                 'Patient ID': True,
@@ -145,7 +165,69 @@ class SettingsManager:
         folder_var = StringVar(value=self.settings.get("output_folder", "out"))
         Entry(frame, textvariable=folder_var, width=20).grid(row=6, column=1)
 
-        a = 7 #number of rows above table settings
+        #Number of decoding workers
+        workers_frame = ttk.Frame(frame)
+        workers_frame.grid(row=7, column=0, sticky="w", pady=10)
+        Label(workers_frame, text="Parallel DICOM decoding workers: ", font=("", get_font_size("large"), "bold")).pack(side="left")
+        info_label4 = Label(workers_frame, image=self.info_icon)
+        info_label4.pack(side="left", padx=(10,0))
+        ToolTip(info_label4, 
+                "Number of threads used to decode the slices of a series. Especially for compressed (e.g. JPEG / JPEG2000) series, using several workers speeds up the loading. Use 1 to decode all slices on the main thread.",
+                parent_window=settings_window)
+        workers_var = StringVar(value=self.settings.get("decode_workers", 4))
+        Entry(frame, textvariable=workers_var, width=5).grid(row=7, column=1)
+
+        #Decoded volume cache
+        cache_frame = ttk.Frame(frame)
+        cache_frame.grid(row=8, column=0, sticky="w", pady=10)
+        Label(cache_frame, text="Decoded volume cache folder: ", font=("", get_font_size("large"), "bold")).pack(side="left")
+        info_label5 = Label(cache_frame, image=self.info_icon)
+        info_label5.pack(side="left", padx=(10,0))
+        ToolTip(info_label5, 
+                "If a folder is given, decoded DICOM volumes are stored there and re-used by later runs (e.g. after a reset or changed settings) without decoding the DICOM files again. Entries are identified by the Series Instance UID and the names, sizes and modification times of the files, so the folder can be shared between directories. Leave empty to disable the cache.",
+                parent_window=settings_window)
+        cache_var = StringVar(value=self.settings.get("volume_cache_dir", ""))
+        Entry(frame, textvariable=cache_var, width=20).grid(row=8, column=1)
+
+        # Checkbox for the consolidated preprocessed store
+        store_frame = ttk.Frame(frame)
+        store_frame.grid(row=9, column=0, sticky="w", pady=10)
+        store_var = BooleanVar(value=self.settings.get("preprocessed_storage", "nrrd") == "store")
+        Label(store_frame, text="Pack preprocessed volumes into one store file:", font=("", get_font_size("large"), "bold")).pack(side="left")
+        info_label6 = Label(store_frame, image=self.info_icon)
+        info_label6.pack(side="left", padx=(10,0))
+        ToolTip(info_label6, 
+                "Only relevant if preprocessed files are stored. If activated, all preprocessed volumes are written into a single file (preprocessed_store.sqlite), compressed per slice, instead of one NRRD file per series. The prediction then only reads the slices it needs.",
+                parent_window=settings_window)
+        store_checkbox = Checkbutton(frame, variable=store_var)
+        store_checkbox.grid(row=9, column=1)
+
+        # Checkbox for the header filter
+        filter_frame = ttk.Frame(frame)
+        filter_frame.grid(row=10, column=0, sticky="w", pady=10)
+        header_filter_var = BooleanVar(value=self.settings.get("header_filter", True))
+        Label(filter_frame, text="Skip scouts, non-CT and non-image series:", font=("", get_font_size("large"), "bold")).pack(side="left")
+        info_label7 = Label(filter_frame, image=self.info_icon)
+        info_label7.pack(side="left", padx=(10,0))
+        ToolTip(info_label7, 
+                "If activated, series are checked during the listing by the header of one of their files (Modality, Image Type, SOP Class UID and image information). Localizers, dose reports, secondary captures and series of other modalities are not listed, they are written with the reason to rejected_series.csv in the output folder. If you change this setting while series are already loaded, a reset will be performed automatically.",
+                parent_window=settings_window)
+        header_filter_checkbox = Checkbutton(frame, variable=header_filter_var)
+        header_filter_checkbox.grid(row=10, column=1)
+
+        #Scan index folder
+        index_frame = ttk.Frame(frame)
+        index_frame.grid(row=11, column=0, sticky="w", pady=10)
+        Label(index_frame, text="Series listing index folder: ", font=("", get_font_size("large"), "bold")).pack(side="left")
+        info_label8 = Label(index_frame, image=self.info_icon)
+        info_label8.pack(side="left", padx=(10,0))
+        ToolTip(info_label8, 
+                "The listing remembers which folders it has already scanned, so listing the same directory again (e.g. after a reset, or after a few studies were added) only scans the folders that changed. The number of folders of the last listing, used for its progress estimate, is kept there too. Leave empty to keep this index in the user's application data, or give a folder to keep it there (e.g. on a shared drive).",
+                parent_window=settings_window)
+        index_var = StringVar(value=self.settings.get("scan_index_dir", ""))
+        Entry(frame, textvariable=index_var, width=20).grid(row=11, column=1)
+
+        a = 12 #number of rows above table settings
         # Table settings labels
         label_frame = ttk.Frame(frame)
         label_frame.grid(row=a, column=0, sticky="w", pady=(10,0))
@@ -196,18 +278,25 @@ class SettingsManager:
             self.settings["store_nrrd_files"] = store_nrrd_var.get()
             self.settings["verbose"] = verbose_var.get()
             self.settings["human_readable_output"] = human_var.get()
+            self.settings["decode_workers"] = max(1, int(workers_var.get())) if workers_var.get().isdigit() else 1
+            self.settings["volume_cache_dir"] = cache_var.get().strip()
+            self.settings["scan_index_dir"] = index_var.get().strip()
+            self.settings["preprocessed_storage"] = "store" if store_var.get() else "nrrd"
             
 
 
             new_min = int(min_dcm_var.get()) if min_dcm_var.get().isdigit() else 1
             new_out_folder = folder_var.get()
             new_dcm_ending = dcm_ending_var.get()
-            if new_min != self.settings.get("min_dcm",1) or new_out_folder!=self.settings.get("output_folder", "out") or new_dcm_ending!=self.settings.get("dcm_ending",True):
+            new_header_filter = header_filter_var.get()
+            if new_min != self.settings.get("min_dcm",1) or new_out_folder!=self.settings.get("output_folder", "out") or new_dcm_ending!=self.settings.get("dcm_ending",True) \
+                or new_header_filter != self.settings.get("header_filter", True):
                 app.reset(show_confirm=False)
                 self.reset_happened=True
             self.settings["min_dcm"] = new_min
             self.settings["output_folder"] = new_out_folder
             self.settings["dcm_ending"] = new_dcm_ending
+            self.settings["header_filter"] = new_header_filter
             
             
                 
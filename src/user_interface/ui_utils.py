@@ -4,6 +4,7 @@ import webbrowser
 import os
 from PIL import Image, ImageTk
 import sys
+import time
 
 
 # Get the absolute path to the folder where the executable/script is located
@@ -102,6 +103,14 @@ def get_mgh_logo(width=20):
 def get_falcon(width=100):
     return resize_image(os.path.join(icon_folder, 'falcon.png'), width)
 
+def wait_for_future(future, wait_callback=None, interval=0.02):
+    """Wait until future is done, calling wait_callback (e.g. root.update, to keep the GUI responsive) every interval
+    seconds in the meantime. Returns the result of the future."""
+    while wait_callback is not None and not future.done():
+        wait_callback()
+        time.sleep(interval)
+    return future.result()
+
 def update_start_button(app, mode="Start"):
     app.start_canvas.delete("all")
     app.start_canvas.unbind("<Button-1>")